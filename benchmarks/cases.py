@@ -0,0 +1,424 @@
+""" Benchmark cases for the mortise hot paths.
+
+Each case is registered with @benchmark and is called with a `quick`
+flag (smaller workloads for a fast smoke run). Cases return a dict of
+metrics; throughput metrics are named *_per_sec so that the runner
+knows bigger is better, everything else is treated as lower is
+better.
+"""
+
+import gc
+import queue
+import time
+import tracemalloc
+
+import mortise
+from mortise import State
+from mortise.metrics import MetricsRegistry
+from mortise.trace import Tracer
+
+
+CASES = {}
+
+
+def benchmark(name):
+    def register(fn):
+        CASES[name] = fn
+        return fn
+    return register
+
+
+def _best_rate(fn, ops, repeat=5):
+    """Runs fn (which performs `ops` operations) `repeat` times and
+    returns the best operations/sec.
+
+    """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return ops / best
+
+
+class Wait(State):
+    def on_state(self, st):
+        if st.msg == 'swallow':
+            return True
+
+
+class Ping(State):
+    def on_state(self, st):
+        if st.msg:
+            return Pong
+
+
+class Pong(State):
+    def on_state(self, st):
+        if st.msg:
+            return Ping
+
+
+class Pusher(State):
+    def on_state(self, st):
+        if st.msg:
+            return mortise.Push(Popper, Pusher)
+
+
+class Popper(State):
+    def on_state(self, st):
+        if st.msg:
+            return mortise.Pop
+
+
+class Timed(State):
+    TIMEOUT = 60
+
+    def on_state(self, st):
+        if st.msg:
+            return TimedOther
+
+
+class TimedOther(State):
+    TIMEOUT = 60
+
+    def on_state(self, st):
+        if st.msg:
+            return Timed
+
+
+class ErrorState(State):
+    def on_state(self, st):
+        pass
+
+
+def _machine(initial, **kwargs):
+    kwargs.setdefault('dwell_states', [Wait, Ping, Pong, Pusher, Popper])
+    kwargs.setdefault('log_fn', None)
+    return mortise.StateMachine(initial, mortise.DefaultStates.End,
+                                ErrorState, **kwargs)
+
+
+@benchmark('tick_blocking')
+def tick_blocking(quick):
+    """Raw tick() throughput on a state that swallows every message.
+
+    """
+    ops = 20000 if quick else 200000
+    fsm = _machine(Wait)
+    fsm.tick()
+
+    def run():
+        tick = fsm.tick
+        for _ in range(ops):
+            tick('swallow')
+
+    return {'ticks_per_sec': _best_rate(run, ops)}
+
+
+@benchmark('metrics')
+def metrics(quick):
+    """tick() and transition throughput with metrics collection on, and
+    the cost of rendering them.
+
+    """
+    ops = 20000 if quick else 200000
+    registry = MetricsRegistry()
+    result = {}
+    for name, initial in (('ticks_per_sec', Wait),
+                          ('transitions_per_sec', Ping)):
+        fsm = _machine(initial, metrics=registry.machine(name))
+        fsm.tick()
+
+        def run():
+            tick = fsm.tick
+            for _ in range(ops):
+                tick('swallow')
+        result[name] = _best_rate(run, ops)
+
+    result['renders_per_sec'] = _best_rate(registry.render, 1)
+    return result
+
+
+@benchmark('trace')
+def trace(quick):
+    """Transition throughput with a Tracer attached, tracing every tick
+    and one tick in 100.
+
+    """
+    ops = 20000 if quick else 200000
+    result = {}
+    for name, sample_every in (('traced_per_sec', 1),
+                               ('sampled_per_sec', 100)):
+        fsm = _machine(Ping, tracer=Tracer(sample_every=sample_every))
+        fsm.tick()
+
+        def run():
+            tick = fsm.tick
+            for _ in range(ops):
+                tick('swallow')
+        result[name] = _best_rate(run, ops)
+    return result
+
+
+@benchmark('tick_status')
+def tick_status(quick):
+    """Idling in an untimed state: BlockedInUntimedState raised on every
+    tick, against tick_status mode returning BLOCKED_UNTIMED.
+
+    """
+    ops = 20000 if quick else 200000
+
+    fsm = _machine(Wait, dwell_states=[])
+    try:
+        fsm.tick()
+    except mortise.BlockedInUntimedState:
+        pass
+
+    def raising():
+        tick = fsm.tick
+        for _ in range(ops):
+            try:
+                tick('swallow')
+            except mortise.BlockedInUntimedState:
+                pass
+
+    status_fsm = _machine(Wait, dwell_states=[], tick_status=True)
+    status_fsm.tick()
+
+    def returning():
+        tick = status_fsm.tick
+        for _ in range(ops):
+            tick('swallow')
+
+    return {'raising_per_sec': _best_rate(raising, ops),
+            'status_per_sec': _best_rate(returning, ops)}
+
+
+@benchmark('tick_many')
+def tick_many(quick):
+    """tick_many() throughput on the same workload as tick_blocking.
+
+    """
+    ops = 20000 if quick else 200000
+    fsm = _machine(Wait)
+    fsm.tick()
+    messages = ['swallow'] * ops
+
+    return {'ticks_per_sec': _best_rate(lambda: fsm.tick_many(messages),
+                                        ops)}
+
+
+@benchmark('transitions')
+def transitions(quick):
+    """Transitions/sec bouncing between two states.
+
+    """
+    ops = 20000 if quick else 200000
+    fsm = _machine(Ping)
+    fsm.tick()
+
+    def run():
+        tick = fsm.tick
+        for _ in range(ops):
+            tick('go')
+
+    return {'transitions_per_sec': _best_rate(run, ops)}
+
+
+@benchmark('transitions_reuse')
+def transitions_reuse(quick):
+    """As transitions, with reuse_states=True.
+
+    """
+    ops = 20000 if quick else 200000
+    fsm = _machine(Ping, reuse_states=True)
+    fsm.tick()
+
+    def run():
+        tick = fsm.tick
+        for _ in range(ops):
+            tick('go')
+
+    return {'transitions_per_sec': _best_rate(run, ops)}
+
+
+@benchmark('push_pop')
+def push_pop(quick):
+    """Push/Pop churn on the state stack (two transitions per cycle).
+
+    """
+    ops = 10000 if quick else 100000
+    fsm = _machine(Pusher)
+    fsm.tick()
+
+    def run():
+        tick = fsm.tick
+        for _ in range(ops):
+            tick('push')
+            tick('pop')
+
+    return {'cycles_per_sec': _best_rate(run, ops)}
+
+
+@benchmark('timer_arm_cancel')
+def timer_arm_cancel(quick):
+    """Cost of arming and cancelling failsafe timers, both through
+    TIMEOUT state transitions and directly on the timer backend.
+
+    """
+    ops = 10000 if quick else 100000
+    fsm = _machine(Timed)
+    fsm.tick()
+
+    def run_fsm():
+        tick = fsm.tick
+        for _ in range(ops):
+            tick('go')
+
+    backend = fsm.timer_backend
+
+    def run_backend():
+        for _ in range(ops):
+            handle = backend.timer(60, None)
+            handle.start()
+            handle.cancel()
+
+    result = {
+        'timed_transitions_per_sec': _best_rate(run_fsm, ops),
+        'arm_cancel_per_sec': _best_rate(run_backend, ops),
+    }
+    fsm.cleanup()
+    return result
+
+
+@benchmark('filter_trap')
+def filter_trap(quick):
+    """Overhead of filter_fn (filtered and passed through) and trap_fn
+    relative to a bare tick.
+
+    """
+    ops = 20000 if quick else 200000
+    trapped = []
+
+    fsm = _machine(Wait, filter_fn=lambda st: st.msg == 'filtered',
+                   trap_fn=lambda st: trapped.append(None))
+    fsm.tick()
+
+    def run(message):
+        def ticks():
+            tick = fsm.tick
+            for _ in range(ops):
+                tick(message)
+        return ticks
+
+    result = {
+        'filtered_per_sec': _best_rate(run('filtered'), ops),
+        'trapped_per_sec': _best_rate(run('trapped'), ops),
+    }
+    del trapped[:]
+    return result
+
+
+@benchmark('queues')
+def queues(quick):
+    """put() followed by drain() through each msg_queue backend.
+
+    """
+    ops = 20000 if quick else 200000
+    result = {}
+    for label, factory in [('queue', queue.Queue),
+                           ('simple_queue', queue.SimpleQueue),
+                           ('deque_queue', mortise.DequeQueue)]:
+        fsm = _machine(Wait, msg_queue=factory())
+        fsm.tick()
+
+        def run():
+            put = fsm.msg_queue.put
+            for _ in range(ops):
+                put('swallow')
+            fsm.drain()
+
+        result['{}_per_sec'.format(label)] = _best_rate(run, ops)
+    return result
+
+
+class Routed(State):
+    HANDLES = ('go',)
+
+    def on_state(self, st):
+        if st.msg and st.msg['type'] == 'go':
+            return True
+
+
+@benchmark('routed_trap')
+def routed_trap(quick):
+    """Messages a state doesn't list in HANDLES, trapped through
+    message_key_fn routing versus through on_state.
+
+    """
+    ops = 20000 if quick else 200000
+    message = {'type': 'telemetry'}
+    result = {}
+    for label, key_fn in [('routed', lambda msg: msg['type']),
+                          ('unrouted', None)]:
+        fsm = _machine(Routed, dwell_states=[Routed],
+                       trap_fn=lambda st: None, message_key_fn=key_fn)
+        fsm.tick()
+
+        def run():
+            tick = fsm.tick
+            for _ in range(ops):
+                tick(message)
+
+        result['{}_per_sec'.format(label)] = _best_rate(run, ops)
+    return result
+
+
+def _machines_memory(count, initial, tick=False):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    fsms = [_machine(initial) for _ in range(count)]
+    created = time.perf_counter() - start
+    if tick:
+        # The first tick enters the initial state (instance, history
+        # entry, timer)
+        for fsm in fsms:
+            fsm.tick()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return fsms, (after - before) / count, created
+
+
+@benchmark('idle_memory')
+def idle_memory(quick):
+    """Memory held by an idle machine that has been ticked once.
+
+    """
+    _, per_machine, _ = _machines_memory(500 if quick else 2000, Wait,
+                                         tick=True)
+    return {'bytes_per_machine': per_machine}
+
+
+@benchmark('scaling')
+def scaling(quick):
+    """Creating and ticking 10k (and, unless quick, 100k) machines.
+
+    """
+    result = {}
+    for count in ([10000] if quick else [10000, 100000]):
+        fsms, per_machine, created = _machines_memory(count, Ping)
+        start = time.perf_counter()
+        for fsm in fsms:
+            fsm.tick('go')
+        ticked = time.perf_counter() - start
+        result['create_{}_sec'.format(count)] = created
+        result['tick_{}_per_sec'.format(count)] = count / ticked
+        result['bytes_per_machine_{}'.format(count)] = per_machine
+        del fsms
+    return result
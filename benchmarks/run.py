@@ -0,0 +1,107 @@
+""" Runs the mortise benchmark suite and reports the results as JSON.
+
+    python -m benchmarks.run                     # full run, JSON to stdout
+    python -m benchmarks.run --quick -o out.json
+    python -m benchmarks.run --compare base.json --threshold 0.1
+
+With --compare, every metric is checked against a previous run and the
+exit status is 1 if any metric regressed by more than --threshold
+(throughput metrics, named *_per_sec, regress when they drop;
+everything else regresses when it grows).
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+from benchmarks.cases import CASES
+
+
+def run_cases(names, quick):
+    results = {}
+    for name in names:
+        sys.stderr.write("{} ... ".format(name))
+        sys.stderr.flush()
+        start = time.perf_counter()
+        results[name] = CASES[name](quick)
+        sys.stderr.write("{:.2f}s\n".format(time.perf_counter() - start))
+    return results
+
+
+def compare(baseline, results, threshold):
+    """Returns a list of (case, metric, old, new, change) for every metric
+    that got worse by more than threshold.
+
+    """
+    regressions = []
+    for case, metrics in results.items():
+        old_metrics = baseline.get(case, {})
+        for metric, new in metrics.items():
+            old = old_metrics.get(metric)
+            if not old:
+                continue
+            change = (new - old) / old
+            worse = -change if metric.endswith('_per_sec') else change
+            if worse > threshold:
+                regressions.append((case, metric, old, new, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('cases', nargs='*',
+                        help="Cases to run (default: all of them)")
+    parser.add_argument('--quick', action='store_true',
+                        help="Smaller workloads, for a fast smoke run")
+    parser.add_argument('-o', '--output',
+                        help="Write the JSON report here instead of stdout")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="JSON report of a previous run to compare with")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Allowed relative regression (default 0.1)")
+    parser.add_argument('--list', action='store_true',
+                        help="List the available cases and exit")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name in CASES:
+            print(name)
+        return 0
+
+    names = args.cases or list(CASES)
+    unknown = [name for name in names if name not in CASES]
+    if unknown:
+        parser.error("Unknown case(s): {}".format(', '.join(unknown)))
+
+    report = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'quick': args.quick,
+        'results': run_cases(names, args.quick),
+    }
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(baseline, report['results'], args.threshold)
+        for case, metric, old, new, change in regressions:
+            sys.stderr.write("REGRESSION {}.{}: {:.6g} -> {:.6g} ({:+.1%})\n"
+                             .format(case, metric, old, new, change))
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
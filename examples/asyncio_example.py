@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+""" Example of many state machines sharing a single asyncio event loop.
+    Handlers may be coroutines, timeouts are scheduled on the loop. """
+
+import asyncio
+import random
+
+import mortise
+from mortise import State
+
+
+class Ping(State):
+    TIMEOUT = 5
+
+    async def on_state(self, st):
+        if st.msg:
+            # Pretend to talk to some device
+            await asyncio.sleep(0.1)
+            print("{} Ping: {}".format(st.common.name, st.msg['data']))
+            return Pong
+
+    def on_timeout(self, st):
+        print("{} timed out waiting for a message".format(st.common.name))
+        return Ping
+
+
+class Pong(State):
+    def on_state(self, st):
+        if st.msg:
+            print("{} Pong: {}".format(st.common.name, st.msg['data']))
+            return Ping
+
+
+class ErrorState(State):
+    def on_state(self, st):
+        pass
+
+
+class Common:
+    def __init__(self, name):
+        self.name = name
+
+
+async def msg_loop(fsms):
+    messages = ['foo', 'bar', 'baz']
+    while True:
+        fsm = random.choice(fsms)
+        fsm.msg_queue.put_nowait({'data': random.choice(messages)})
+        await asyncio.sleep(0.5)
+
+
+async def main():
+    fsms = [
+        mortise.AsyncStateMachine(
+            initial_state=Ping,
+            final_state=mortise.DefaultStates.End,
+            default_error_state=ErrorState,
+            log_fn=print,
+            common_state=Common("fsm{}".format(idx)),
+            dwell_states=[Pong])
+        for idx in range(10)
+    ]
+
+    await asyncio.gather(msg_loop(fsms), *[fsm.run() for fsm in fsms])
+
+asyncio.run(main())
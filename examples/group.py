@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+""" Example of hosting many keyed state machines (one per device) on a
+    small pool of worker threads with a MachineGroup. """
+
+import random
+import time
+
+import mortise
+from mortise import State
+
+
+class Idle(State):
+    def on_state(self, st):
+        if st.msg and st.msg['data'] == 'start':
+            return Running
+
+
+class Running(State):
+    TIMEOUT = 10
+
+    def on_enter(self, st):
+        st.common.readings = 0
+
+    def on_state(self, st):
+        if st.msg:
+            if st.msg['data'] == 'stop':
+                print("{} took {} readings".format(st.common.device,
+                                                   st.common.readings))
+                return Idle
+            st.common.readings += 1
+            return True
+
+    def on_timeout(self, st):
+        print("{} went quiet".format(st.common.device))
+        return Idle
+
+
+class ErrorState(State):
+    def on_state(self, st):
+        pass
+
+
+class Device:
+    def __init__(self, device):
+        self.device = device
+
+
+def make_fsm(key, msg_queue):
+    return mortise.StateMachine(
+        initial_state=Idle,
+        final_state=mortise.DefaultStates.End,
+        default_error_state=ErrorState,
+        msg_queue=msg_queue,
+        common_state=Device(key),
+        dwell_states=[Idle])
+
+
+def main():
+    group = mortise.MachineGroup(make_fsm, workers=4)
+    devices = ["device{}".format(idx) for idx in range(1000)]
+
+    while True:
+        for device in devices:
+            group.submit(device, {'data': 'start'})
+        for _ in range(100):
+            group.submit(random.choice(devices), {'data': 'reading'})
+        for device in devices:
+            group.submit(device, {'data': 'stop'})
+
+        time.sleep(1)
+        print("Queue depth: {}, utilization: {}".format(
+            group.queue_depth,
+            ["{:.2f}".format(w.utilization) for w in group.worker_stats]))
+
+main()
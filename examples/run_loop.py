@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+""" Example of a state machine driven entirely from one thread by
+    StateMachine.run(). Messages arrive on a socket (standing in for a
+    device connection) and the state timeout is fired inline by the run
+    loop, so no timer or reader threads are involved. """
+
+import socket
+
+import mortise
+from mortise import State
+from mortise.timers import InlineTimerBackend
+
+
+class WaitForHello(State):
+    def on_state(self, st):
+        if st.msg == b'hello':
+            print("Device said hello")
+            return WaitForData
+
+
+class WaitForData(State):
+    """ Gives up if the device goes quiet for more than a second. """
+    TIMEOUT = 1
+
+    def on_state(self, st):
+        if st.msg:
+            print("Data: ", st.msg)
+            # Re-arms the timeout
+            return self
+
+    def on_timeout(self, st):
+        print("Device went quiet")
+        return mortise.DefaultStates.End
+
+
+class ErrorState(State):
+    def on_state(self, st):
+        pass
+
+
+def read_message(sock):
+    data = sock.recv(1024)
+    if not data:
+        raise EOFError
+    return data
+
+
+def main():
+    device, ours = socket.socketpair()
+    ours.sendall(b'hello')
+
+    fsm = mortise.StateMachine(
+        initial_state=WaitForHello,
+        final_state=mortise.DefaultStates.End,
+        default_error_state=ErrorState,
+        timer_backend=InlineTimerBackend())
+
+    # Returns once the machine reaches its final state
+    fsm.run({device: read_message})
+
+
+if __name__ == '__main__':
+    main()
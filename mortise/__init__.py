@@ -1,4 +1,25 @@
 from mortise.mortise import *
+from mortise.events import (LogEvent, EventSink, LogFnSink, StreamSink,
+                            LoggerSink, BatchingSink)
+from mortise.history import (HISTORY_OFF, HISTORY_RING, HISTORY_AGGREGATE,
+                             TransitionHistory, EdgeStats, LogHistogram)
+from mortise.timers import (TimerHandle, TimerBackend, ThreadTimerBackend,
+                            HeapTimerBackend, LoopTimerBackend,
+                            InlineTimerBackend,
+                            default_timer_backend)
+from mortise.aio import AsyncStateMachine
+from mortise.snapshot import SnapshotError
+from mortise.journal import (Journal, JournalReader, JournalRecord,
+                             JournalError, ReplayDivergedError, replay)
+from mortise.group import MachineGroup, Mailbox, WorkerStats
+from mortise.timing import HandlerTiming
+from mortise.clock import VirtualClock, monotonic_clock
+from mortise.graph import TransitionGraph
+from mortise.export import GraphExport
+from mortise.metrics import MachineMetrics, MetricsRegistry
+from mortise.trace import Tracer, TraceTrack
+from mortise.queues import (DequeQueue, CoalescingQueue, BLOCK, DROP_OLDEST,
+                            DROP_NEWEST, RAISE)
 
 __all__ = [
     StateRetryLimitError,
@@ -10,10 +31,63 @@ __all__ = [
     NoPushedStatesError,
     Push,
     Pop,
+    StateMeta,
     state_name,
     base_state_name,
     State,
     DefaultStates,
     GenericCommon,
     SharedState,
-    StateMachine]
+    StateMachine,
+    TickSummary,
+    TickStatus,
+    TimerHandle,
+    TimerBackend,
+    ThreadTimerBackend,
+    HeapTimerBackend,
+    LoopTimerBackend,
+    InlineTimerBackend,
+    default_timer_backend,
+    HISTORY_OFF,
+    HISTORY_RING,
+    HISTORY_AGGREGATE,
+    TransitionHistory,
+    EdgeStats,
+    LogHistogram,
+    LogEvent,
+    EventSink,
+    LogFnSink,
+    StreamSink,
+    LoggerSink,
+    BatchingSink,
+    AsyncStateMachine,
+    MachineGroup,
+    Mailbox,
+    WorkerStats,
+    SnapshotError,
+    Journal,
+    JournalReader,
+    JournalRecord,
+    JournalError,
+    ReplayDivergedError,
+    replay,
+    HandlerTiming,
+    VirtualClock,
+    monotonic_clock,
+    UndeclaredTransitionError,
+    InvalidTransitionsError,
+    declared_transitions,
+    transition_table,
+    TransitionGraph,
+    GraphExport,
+    MachineMetrics,
+    MetricsRegistry,
+    Tracer,
+    TraceTrack,
+    SubmitFilterError,
+    DequeQueue,
+    CoalescingQueue,
+    BLOCK,
+    DROP_OLDEST,
+    DROP_NEWEST,
+    RAISE]
@@ -0,0 +1,273 @@
+""" asyncio support for mortise.
+
+AsyncStateMachine runs the same State classes as StateMachine on an
+event loop. Any of the state handlers (on_enter, on_state, on_leave,
+on_timeout, on_fail), as well as filter_fn, trap_fn and on_error_fn,
+may be coroutine functions. Messages travel over an asyncio.Queue and
+timeouts are scheduled with loop.call_later, so a single loop can host
+a very large number of machines without any threads.
+"""
+
+import asyncio
+import inspect
+from time import perf_counter_ns
+
+from mortise.mortise import (StateMachine,
+                             StateRetryLimitError, StateTimedOut,
+                             MissingOnStateHandler,
+                             BLOCKING_RETURNS,
+                             TickStatus)
+from mortise.timers import LoopTimerBackend
+from mortise.timing import ON_ENTER, ON_STATE, ON_LEAVE, ON_TIMEOUT, ON_FAIL
+
+
+async def _call(fn, *args):
+    result = fn(*args)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+async def _call_handler(state, handler, fn, shared_state):
+    timing = state._timing
+    if timing is None:
+        return await _call(fn, shared_state)
+
+    start = perf_counter_ns()
+    try:
+        return await _call(fn, shared_state)
+    finally:
+        timing.record(state, handler, start, perf_counter_ns() - start)
+
+
+async def tick_state(state, shared_state):
+    """Coroutine equivalent of State.tick, awaiting any handler that
+    returns an awaitable.
+
+    """
+    if isinstance(shared_state.msg, StateTimedOut):
+        result = await _call_handler(state, ON_TIMEOUT, state.on_timeout,
+                                     shared_state)
+        if not result:
+            result = shared_state.fsm._err_st
+
+        # A state returning itself from a timeout is 'self ticking',
+        # see State._handle_timeout
+        if result is state or result is state.__class__:
+            state.has_entered = False
+            state._cancel_failsafe()
+            shared_state.msg = None
+        return result
+
+    elif isinstance(shared_state.msg, StateRetryLimitError):
+        result = await _call_handler(state, ON_FAIL, state.on_fail,
+                                     shared_state)
+        if not result:
+            result = shared_state.fsm._err_st
+        return result
+
+    if not state.has_entered:
+        state._handle_retries()
+        await _call_handler(state, ON_ENTER, state.on_enter, shared_state)
+        state._maybe_failsafe_timer(shared_state)
+        state.has_entered = True
+
+    if not state._mortise_meta.has_on_state:
+        raise MissingOnStateHandler(
+            "State {} has no on_state handler!"
+            .format(state.name)
+        )
+    result = await _call_handler(state, ON_STATE, state.on_state,
+                                 shared_state)
+
+    # Early exit, this is a wait condition
+    if result in BLOCKING_RETURNS:
+        return result
+
+    # Retry, re-enter on the next tick
+    if result is state or result is state.__class__:
+        state.has_entered = False
+        state._cancel_failsafe()
+        return result
+
+    await _call_handler(state, ON_LEAVE, state.on_leave, shared_state)
+    state._reset()
+    return result
+
+
+class AsyncStateMachine(StateMachine):
+    """StateMachine driven from an asyncio event loop. Takes the same
+    arguments as StateMachine; msg_queue defaults to an asyncio.Queue
+    (created when the machine is first used, so that it belongs to the
+    running loop) and timer_backend to a LoopTimerBackend.
+
+    tick(), tick_many(), drain() and start_non_blocking() are
+    coroutines. run() ticks the machine with messages from its queue
+    until it reaches its final state.
+
+    With a bounded msg_queue, timeouts and retry failures that find it
+    full wait for the next tick (like a pending timeout) instead of
+    being queued, so they are never lost. submit() raises
+    asyncio.QueueFull.
+
+    transition_fn is still called synchronously.
+
+    """
+    def __init__(self, *args, msg_queue=None, timer_backend=None,
+                 **kwargs):
+        self._queue = None
+        super().__init__(*args,
+                         msg_queue=msg_queue,
+                         timer_backend=timer_backend or LoopTimerBackend(),
+                         **kwargs)
+
+    def _default_queue(self):
+        # Created on first use by _msg_queue
+        return None
+
+    @property
+    def _msg_queue(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    @_msg_queue.setter
+    def _msg_queue(self, msg_queue):
+        self._queue = msg_queue
+
+    def _wake(self):
+        # Runs in a timer callback, see StateMachine._wake
+        try:
+            self._msg_queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+    def _requeue(self, error):
+        try:
+            self._msg_queue.put_nowait(error)
+        except asyncio.QueueFull:
+            self._timeout_queue.append(error)
+
+    def _enqueue(self, message):
+        self._msg_queue.put_nowait(message)
+
+    async def start_non_blocking(self):
+        """Coroutine equivalent of StateMachine.start_non_blocking.
+
+        """
+        self._msg_queue.put_nowait(None)
+        while True:
+            msg = await self._msg_queue.get()
+            if self._non_blocking_done(await self._status_tick(msg)):
+                return
+
+    async def tick(self, message=None):
+        if self._tick_status:
+            status = await self._status_tick(message)
+            if status is TickStatus.BLOCKED_UNTIMED:
+                self._blocked()
+            return status
+        if await self._tick_one(message):
+            self._finish_tick()
+
+    async def _status_tick(self, message):
+        start_id = self._transition_id
+        if not await self._tick_one(message):
+            return TickStatus.FILTERED
+        return self._tick_result(start_id)
+
+    async def tick_many(self, messages):
+        start_id = self._transition_id
+        count = filtered = 0
+        for message in messages:
+            count += 1
+            if not await self._tick_one(message):
+                filtered += 1
+            elif self._is_finished:
+                break
+        return self._tick_many_result(start_id, count, filtered)
+
+    async def drain(self, max_items=None):
+        return await self.tick_many(self._drain_queue(max_items))
+
+    def _drain_queue(self, max_items):
+        get = self._msg_queue.get_nowait
+        count = 0
+        while max_items is None or count < max_items:
+            try:
+                message = get()
+            except asyncio.QueueEmpty:
+                return
+            count += 1
+            yield message
+
+    async def _tick_one(self, message):
+        tracer = self._tracer
+        if tracer is not None and not tracer.active and tracer.sample():
+            start = tracer.begin_tick(self)
+            try:
+                return await self._tick_one(message)
+            finally:
+                tracer.end_tick(self, start)
+
+        # Same steps as StateMachine._tick_one, awaiting the handlers
+        received = self._receive(message)
+        if received is None:
+            return True
+        screen, filter_exception = received
+        if screen:
+            try:
+                if self._filter_fn and await _call(self._filter_fn,
+                                                   self._shared_state):
+                    if self._metrics is not None:
+                        self._metrics.filtered += 1
+                    return False
+                if self._skips_state(message):
+                    if self._trap_fn:
+                        await _call(self._trap_fn, self._shared_state)
+                    return True
+            except Exception as e:
+                filter_exception = e
+
+        fsm_busy = True
+        while fsm_busy:
+            try:
+                if self._take_timeout():
+                    break
+
+                if filter_exception:
+                    raise filter_exception
+
+                next_state = await tick_state(self._current,
+                                              self._shared_state)
+
+                if self._trapped(next_state) and self._trap_fn:
+                    await _call(self._trap_fn, self._shared_state)
+                fsm_busy = self._handle_next_state(next_state)
+            except (StateRetryLimitError, StateTimedOut) as e:
+                self._state_failed(e)
+                break
+            except Exception as e:
+                filter_exception = None
+                next_state = None
+                if self._on_err_fn:
+                    next_state = await _call(self._on_err_fn,
+                                             self._shared_state, e)
+                self._handle_error(e, next_state)
+
+        return True
+
+    async def run(self):
+        """Ticks the state machine until it completes. Messages are
+        taken from msg_queue, exceptions other than StateMachineComplete
+        propagate to the caller.
+
+        """
+        try:
+            status = await self._status_tick(None)
+            while status is not TickStatus.FINISHED:
+                if status is TickStatus.BLOCKED_UNTIMED:
+                    raise self._blocked()
+                status = await self._status_tick(await self._msg_queue.get())
+        finally:
+            self.cleanup()
@@ -0,0 +1,106 @@
+""" Clocks used by state machines to time transitions.
+
+A clock is any callable returning a monotonic time in integer
+nanoseconds; StateMachine uses time.monotonic_ns unless told
+otherwise. VirtualClock is a clock that only moves when it is told to
+and that doubles as a timer backend, so that state TIMEOUTs expire
+deterministically (and instantly) when the clock is advanced.
+"""
+
+import heapq
+import itertools
+import time
+
+from mortise.timers import TimerBackend
+
+
+monotonic_clock = time.monotonic_ns
+
+
+class VirtualClock(TimerBackend):
+    """Manually advanced clock and timer backend.
+
+    Timers armed on a VirtualClock never fire on their own. advance()
+    moves the clock forward and fires every timer that falls due, in
+    deadline order and in the calling thread; while a timer fires, the
+    clock reads its deadline. A fired state timeout is queued on its
+    machine in the usual way and is handled on the machine's next tick
+    (e.g. fsm.drain()).
+
+    A VirtualClock must only be used from one thread.
+
+    """
+    def __init__(self, start_ns=0):
+        super().__init__()
+        self._now_ns = start_ns
+        self._heap = []
+        self._seq = itertools.count()
+
+    def __call__(self):
+        return self._now_ns
+
+    @property
+    def now(self):
+        """The current virtual time, in seconds.
+
+        """
+        return self._now_ns / 1e9
+
+    def _now(self):
+        return self._now_ns / 1e9
+
+    def advance(self, seconds):
+        """Moves the clock forward by seconds, firing any timers that
+        expire on the way. Returns the number of timers fired.
+
+        """
+        if seconds < 0:
+            raise ValueError("Can't move a VirtualClock backwards")
+        return self.advance_to(self._now_ns + int(round(seconds * 1e9)))
+
+    def advance_to(self, target):
+        """As advance(), to an absolute time in nanoseconds.
+
+        """
+        if target < self._now_ns:
+            raise ValueError("Can't move a VirtualClock backwards")
+
+        fired = 0
+        heap = self._heap
+        while heap and heap[0][0] <= target:
+            deadline, _, handle = heapq.heappop(heap)
+            if handle is None:
+                continue
+            self._now_ns = max(self._now_ns, deadline)
+            handle._entry = None
+            self._armed -= 1
+            handle._fire()
+            fired += 1
+
+        self._now_ns = target
+        return fired
+
+    def next_deadline_ns(self):
+        """Absolute time (in nanoseconds) at which the earliest armed
+        timer fires, or None.
+
+        """
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def _arm(self, handle):
+        if handle._entry is not None:
+            self._cancel(handle)
+        deadline = self._now_ns + int(round(handle.duration * 1e9))
+        handle.deadline = deadline / 1e9
+        entry = [deadline, next(self._seq), handle]
+        handle._entry = entry
+        heapq.heappush(self._heap, entry)
+        self._armed += 1
+
+    def _cancel(self, handle):
+        handle._entry[2] = None
+        handle._entry = None
+        self._armed -= 1
@@ -0,0 +1,175 @@
+""" Structured logging events emitted by state machines, and the sinks
+that consume them.
+
+Events are only constructed when a sink is attached and its level
+admits them, and formatting into text is deferred until a sink needs
+it (which, for a BatchingSink, happens on its writer thread).
+"""
+
+import collections
+import sys
+import threading
+import traceback
+
+
+# Same values as the standard logging module
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+TRANSITION = 'transition'
+STALE_TIMEOUT = 'stale_timeout'
+UNRECORDED_MESSAGE = 'unrecorded_message'
+
+EVENT_FORMATS = {
+    TRANSITION: "State Transition: {} -> {}",
+    STALE_TIMEOUT: "Timed out while executing state. Moving on anyway. ({})",
+    UNRECORDED_MESSAGE: "Message of type {} not journaled: {!r}",
+}
+
+
+class LogEvent:
+    """A single structured event. args are the values interpolated into
+    the kind's entry in EVENT_FORMATS.
+
+    """
+    __slots__ = ('level', 'kind', 'fsm', 'args')
+
+    def __init__(self, level, kind, fsm, args):
+        self.level = level
+        self.kind = kind
+        self.fsm = fsm
+        self.args = args
+
+    def format(self):
+        return EVENT_FORMATS[self.kind].format(*self.args)
+
+    __str__ = format
+
+
+class EventSink:
+    """Base class for event sinks. Subclasses implement emit (and
+    optionally emit_many for bulk writes). Events below level are never
+    constructed by the state machine.
+
+    """
+    def __init__(self, level=INFO):
+        self.level = level
+
+    def emit(self, event):
+        raise NotImplementedError
+
+    def emit_many(self, events):
+        for event in events:
+            self.emit(event)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class LogFnSink(EventSink):
+    """Adapter for the original log_fn interface: each event is
+    formatted and passed to log_fn as a string.
+
+    """
+    def __init__(self, log_fn, level=INFO):
+        super().__init__(level)
+        self.log_fn = log_fn
+
+    def emit(self, event):
+        self.log_fn(event.format())
+
+
+class StreamSink(EventSink):
+    """Writes one line per event to a text stream (stdout by default),
+    writing batches with a single write call.
+
+    """
+    def __init__(self, stream=None, level=INFO):
+        super().__init__(level)
+        self.stream = stream or sys.stdout
+
+    def emit(self, event):
+        self.stream.write(event.format() + "\n")
+
+    def emit_many(self, events):
+        if events:
+            self.stream.write(
+                "".join(event.format() + "\n" for event in events))
+
+    def flush(self):
+        self.stream.flush()
+
+
+class LoggerSink(EventSink):
+    """Forwards events to a standard library logging.Logger.
+
+    """
+    def __init__(self, logger, level=INFO):
+        super().__init__(level)
+        self.logger = logger
+
+    def emit(self, event):
+        # logging formats lazily, only if a handler accepts the record
+        self.logger.log(event.level, '%s', event)
+
+
+class BatchingSink(EventSink):
+    """Buffers events and hands them to another sink in bulk from a
+    background thread, so that neither formatting nor I/O happens on
+    the thread ticking the state machine.
+
+    Buffered events are flushed every flush_interval seconds, or sooner
+    once max_batch events are pending. Call close() to stop the writer
+    and flush anything left over.
+
+    """
+    def __init__(self, sink, max_batch=1024, flush_interval=0.1):
+        super().__init__(sink.level)
+        self.sink = sink
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._pending = collections.deque()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='mortise-log', daemon=True)
+        self._thread.start()
+
+    def emit(self, event):
+        # deque.append is atomic, no lock needed on the hot path
+        self._pending.append(event)
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    def _drain(self):
+        pending = self._pending
+        batch = []
+        while pending:
+            batch.append(pending.popleft())
+        if batch:
+            self.sink.emit_many(batch)
+            self.sink.flush()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self._drain()
+            except Exception:
+                traceback.print_exc()
+
+    def flush(self):
+        self._wakeup.set()
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self._drain()
+        self.sink.close()
@@ -0,0 +1,172 @@
+""" Streaming export of the transition graphs state machines have taken.
+
+GraphExport collects the edges of one or more machines (typically many
+machines of the same type) and writes them straight to a file object as
+graphviz DOT, JSON or CSV, one edge at a time. Edges are keyed by state
+name, and each edge's timings are kept as a single EdgeStats that
+machines' histories are merged into, so memory stays proportional to
+the number of distinct edges however long the machines have run.
+"""
+
+import csv
+import json
+
+from mortise.history import EdgeStats
+from mortise.mortise import state_name, base_state_name
+
+
+EDGE_FIELDS = ('from', 'to', 'from_base', 'to_base', 'taken', 'declared',
+               'count', 'min', 'mean', 'max', 'p50', 'p99')
+
+
+def stats_label(edge, stats):
+    """Default DOT edge label: transition count and p50/p99 time spent in
+    the source state, in seconds.
+
+    """
+    if stats is None or not stats.count:
+        return ""
+    hist = stats.histogram
+    return "n={} p50={:.2} p99={:.2}".format(
+        stats.count, hist.percentile(50), hist.percentile(99))
+
+
+def write_dot(fp, nodes, edges):
+    """Writes a DOT digraph to a text file object, one line at a time.
+    nodes are (base name, name, attributes) tuples, drawn in a cluster
+    per base state name, and edges (from, to, attributes) tuples, where
+    attributes is a DOT attribute list such as 'style=dashed', or None.
+
+    """
+    clusters = {}
+    for base, name, attributes in nodes:
+        cluster = clusters.setdefault(base, {})
+        if cluster.get(name) is None:
+            cluster[name] = attributes
+
+    fp.write("digraph Cutter_State {\n\trankdir=LR;\n\tnodesep=0.5;\n")
+    for cname, cluster in clusters.items():
+        fp.write("\tsubgraph cluster_{} {{\n".format(cname))
+        fp.write("\t\tlabel=\"{}\"".format(cname))
+        for node, attributes in cluster.items():
+            if attributes:
+                fp.write("\t\t{} [ {} ];\n".format(node, attributes))
+            else:
+                fp.write("\t\t{};\n".format(node))
+        fp.write("\tcolor=black;\n")
+        fp.write("\t}\n\n")
+
+    for first, second, attributes in edges:
+        if attributes:
+            fp.write("{}->{} [ {} ];\n".format(first, second, attributes))
+        else:
+            fp.write("{}->{};\n".format(first, second))
+    fp.write("}\n")
+
+
+class GraphExport:
+    """Transition graph merged across machines, for export.
+
+    add(fsm) merges in the edges a machine has taken, with their
+    timings if its history is on, and the untaken transitions its
+    states declare. merge(other) merges in another GraphExport, so
+    exports of machines in different threads or processes can be
+    combined without their raw history.
+
+    write_dot() labels edges with label_fn(edge, stats), where edge is
+    the (from base, from, to base, to) name tuple and stats its merged
+    EdgeStats (None if no timings were recorded). Untaken declared edges
+    are drawn dashed.
+
+    """
+    def __init__(self, label_fn=stats_label):
+        self.label_fn = label_fn
+        self._taken = {}
+        self._declared = set()
+
+    def _add_edge(self, edge, stats=None):
+        merged = self._taken.get(edge)
+        if merged is None:
+            merged = self._taken[edge] = EdgeStats()
+        if stats is not None:
+            merged.merge(stats)
+
+    def add(self, fsm):
+        history = fsm.history
+        for edge in fsm._transitions:
+            self._add_edge(edge, history.stats(edge))
+
+        for first, second in fsm.transition_graph.edges:
+            self._declared.add((base_state_name(first), state_name(first),
+                                base_state_name(second), state_name(second)))
+        return self
+
+    def merge(self, other):
+        for edge, stats in other._taken.items():
+            self._add_edge(edge, stats)
+        self._declared.update(other._declared)
+        return self
+
+    def stats(self, edge):
+        return self._taken.get(edge)
+
+    def edges(self):
+        """Yields (edge, taken, declared, stats) for every edge, taken
+        edges first.
+
+        """
+        for edge, stats in self._taken.items():
+            yield edge, True, edge in self._declared, stats
+        for edge in self._declared:
+            if edge not in self._taken:
+                yield edge, False, True, None
+
+    def _dot_nodes(self):
+        for (first_base, first, second_base, second), _, _, _ in self.edges():
+            yield first_base, first, None
+            yield second_base, second, None
+
+    def _dot_edges(self):
+        for edge, taken, _, stats in self.edges():
+            _, first, _, second = edge
+            if taken:
+                label = self.label_fn(edge, stats if stats.count else None)
+                yield first, second, 'label="{}"'.format(label)
+            else:
+                yield first, second, 'style=dashed'
+
+    def write_dot(self, fp):
+        write_dot(fp, self._dot_nodes(), self._dot_edges())
+
+    def _rows(self):
+        for edge, taken, declared, stats in self.edges():
+            first_base, first, second_base, second = edge
+            row = [first, second, first_base, second_base, taken, declared,
+                   0, None, None, None, None, None]
+            if stats is not None and stats.count:
+                hist = stats.histogram
+                row[6:] = [stats.count, stats.min, stats.mean, stats.max,
+                           hist.percentile(50), hist.percentile(99)]
+            yield row
+
+    def write_json(self, fp):
+        """Writes {"edges": [...]} with one object per edge (see
+        EDGE_FIELDS), one edge per line. Times are in seconds.
+
+        """
+        fp.write('{"edges": [')
+        sep = "\n"
+        for row in self._rows():
+            fp.write(sep)
+            fp.write(json.dumps(dict(zip(EDGE_FIELDS, row))))
+            sep = ",\n"
+        fp.write('\n]}\n')
+
+    def write_csv(self, fp):
+        """Writes a header row of EDGE_FIELDS and a row per edge.
+
+        """
+        writer = csv.writer(fp)
+        writer.writerow(EDGE_FIELDS)
+        for row in self._rows():
+            writer.writerow(row)
@@ -0,0 +1,124 @@
+""" Static analysis of the transitions that states declare in
+TRANSITIONS.
+"""
+
+import collections
+import io
+
+from mortise.export import write_dot
+from mortise.mortise import (Push, Pop, state_name, base_state_name,
+                             declared_transitions, transition_table)
+
+
+class TransitionGraph:
+    """The transition graph of a machine configuration, as far as its
+    states declare TRANSITIONS. It is built without running anything,
+    from the same table the machine uses to check transitions.
+
+    Edges are (from class, to class) pairs. A Push leads to its first
+    state; a Pop may lead to any state that some declared Push leaves
+    on the stack. A state with a TIMEOUT or RETRIES can also reach the
+    error state. States that don't declare TRANSITIONS are in
+    `undeclared`: their edges are unknown, so they are assumed to be
+    able to reach the final state.
+
+    The error state is only considered reachable through declared
+    edges; an on_error_fn may of course lead anywhere at runtime.
+
+    """
+    def __init__(self, initial_state, final_state, error_state,
+                 dwell_states=()):
+        self.initial_state = initial_state
+        self.final_state = final_state
+        self.error_state = error_state
+
+        table = dict(transition_table(initial_state, final_state,
+                                      error_state, dwell_states))
+        self.states = set(table)
+        self.undeclared = set()
+        self.edges = set()
+
+        pushed = set()
+        poppers = []
+        for state in table:
+            declared = declared_transitions(state)
+            if declared is None:
+                self.undeclared.add(state)
+                continue
+
+            meta = state._mortise_meta
+            if meta.timeout or meta.retries is not None:
+                self.edges.add((state, error_state))
+            for target in declared:
+                if isinstance(target, Push):
+                    self.edges.add((state, target.push_states[0]))
+                    pushed.update(target.push_states[1:])
+                elif target is Pop:
+                    poppers.append(state)
+                else:
+                    self.edges.add((state, target))
+
+        for state in poppers:
+            for target in pushed:
+                self.edges.add((state, target))
+
+        self._successors = collections.defaultdict(set)
+        self._predecessors = collections.defaultdict(set)
+        for first, second in self.edges:
+            self._successors[first].add(second)
+            self._predecessors[second].add(first)
+
+        self.reachable = self._walk([initial_state], self._successors)
+
+    @staticmethod
+    def _walk(roots, neighbours):
+        seen = set(roots)
+        todo = list(roots)
+        while todo:
+            for state in neighbours[todo.pop()]:
+                if state not in seen:
+                    seen.add(state)
+                    todo.append(state)
+        return seen
+
+    def successors(self, state):
+        return set(self._successors[state])
+
+    def unreachable(self, states=None):
+        """Returns the states (by default, every state the graph knows
+        about) that can't be reached from the initial state.
+
+        """
+        if states is None:
+            states = self.states
+        return set(state for state in states if state not in self.reachable)
+
+    @property
+    def dead_ends(self):
+        """Reachable states from which the final state can't be reached.
+
+        """
+        finishing = self._walk([self.final_state] + list(self.undeclared),
+                               self._predecessors)
+        return set(state for state in self.reachable
+                   if state not in finishing)
+
+    def write_dot(self, fp):
+        """Writes the graph to a text file object in graphviz DOT
+        format. Undeclared states are drawn dashed.
+
+        """
+        nodes = ((base_state_name(state), state_name(state),
+                  'style=dashed' if state in self.undeclared else None)
+                 for state in self.states)
+        edges = ((state_name(first), state_name(second), None)
+                 for first, second in self.edges)
+        write_dot(fp, nodes, edges)
+
+    def digraph(self):
+        """Returns the graph in graphviz DOT format, see write_dot().
+
+        """
+        buf = io.StringIO()
+        self.write_dot(buf)
+        return buf.getvalue()
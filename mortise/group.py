@@ -0,0 +1,290 @@
+""" Hosting many state machines on a small pool of worker threads.
+"""
+
+import collections
+import queue
+import threading
+import time
+import traceback
+
+from mortise.mortise import StateMachineComplete, TickStatus
+
+
+class Mailbox:
+    """Per-machine message queue handed to each StateMachine in a
+    MachineGroup as its msg_queue. It implements the parts of the
+    queue.Queue interface that StateMachine uses, and schedules the
+    machine on the group whenever it goes from idle to having work.
+
+    A mailbox is only ever drained by one worker at a time, which is
+    what guarantees per-key ordering and that a machine is never ticked
+    concurrently. Once its machine has been removed from the group the
+    mailbox is closed, and messages put to it are dropped.
+
+    """
+    __slots__ = ('key', 'fsm', '_group', '_items', '_lock', '_scheduled',
+                 '_closed')
+
+    def __init__(self, group, key):
+        self.key = key
+        self.fsm = None
+        self._group = group
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._scheduled = False
+        self._closed = False
+
+    def put(self, item, block=True, timeout=None):
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._items.append(item)
+                if self._scheduled:
+                    return
+                self._scheduled = True
+        if closed:
+            self._group._dropped(self.key, item)
+        else:
+            self._group._ready.put(self)
+
+    put_nowait = put
+
+    def get(self, block=True, timeout=None):
+        # Machines in a group are only ticked when they have work, so
+        # there is never anything to wait for
+        return self.get_nowait()
+
+    def get_nowait(self):
+        try:
+            return self._items.popleft()
+        except IndexError:
+            raise queue.Empty
+
+    def empty(self):
+        return not self._items
+
+    def qsize(self):
+        return len(self._items)
+
+    def _close(self):
+        """Closes the mailbox and returns the messages left in it.
+
+        """
+        with self._lock:
+            self._closed = True
+            items = list(self._items)
+            self._items.clear()
+        return items
+
+
+class WorkerStats:
+    """Bookkeeping for a single MachineGroup worker thread. ticks counts
+    the messages from batches that completed without raising, busy is
+    the time (in seconds) spent ticking machines.
+
+    """
+    __slots__ = ('name', 'ticks', 'busy', 'started')
+
+    def __init__(self, name):
+        self.name = name
+        self.ticks = 0
+        self.busy = 0.0
+        self.started = time.perf_counter()
+
+    @property
+    def utilization(self):
+        """Fraction of the worker's lifetime spent ticking machines.
+
+        """
+        elapsed = time.perf_counter() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return min(self.busy / elapsed, 1.0)
+
+
+class MachineGroup:
+    """Hosts any number of keyed state machines on a fixed pool of
+    worker threads.
+
+    factory(key, msg_queue) is called the first time a key is seen and
+    must return a StateMachine built with the given msg_queue. The new
+    machine gets the usual initial tick() before any messages. The
+    factory runs without any group lock held; if producers race on a
+    new key it may be called more than once, and only one of the
+    machines is kept (the others are cleaned up without being ticked).
+
+    Messages are routed with submit(key, message). Messages for the
+    same key are processed in order and a machine is never ticked by
+    two workers at once; idle machines don't hold a thread. Each
+    scheduling of a machine handles at most `batch` messages before it
+    goes to the back of the run queue, so that a busy key can't starve
+    the others. Batches are handled with StateMachine.drain().
+
+    When a machine completes it is cleaned up, removed from the group
+    and on_complete(key, fsm) is called, if given. Any other exception
+    raised from tick (including BlockedInUntimedState) is passed to
+    on_error(key, fsm, exc); without an on_error the traceback is
+    printed and the machine carries on.
+
+    Messages still queued for a machine when it is removed, and messages
+    submitted to it afterwards through a reference to it, are dropped:
+    they are counted in `dropped` and passed to on_drop(key, message),
+    if given (on the thread that removed the machine or submitted the
+    message).
+
+    """
+    def __init__(self, factory, workers=4, batch=64,
+                 on_complete=None, on_error=None, on_drop=None):
+        self._factory = factory
+        self._batch = batch
+        self._on_complete = on_complete
+        self._on_error = on_error
+        self._on_drop = on_drop
+        self.dropped = 0
+
+        self._mailboxes = {}
+        self._lock = threading.Lock()
+        self._ready = queue.SimpleQueue()
+
+        self._stats = []
+        self._threads = []
+        for idx in range(workers):
+            stats = WorkerStats('mortise-worker-{}'.format(idx))
+            thread = threading.Thread(target=self._run, args=[stats],
+                                      name=stats.name, daemon=True)
+            self._stats.append(stats)
+            self._threads.append(thread)
+            thread.start()
+
+    def _mailbox(self, key):
+        mailbox = self._mailboxes.get(key)
+        if mailbox is not None:
+            return mailbox
+
+        # Built outside the lock, so that a slow factory (or one that
+        # uses the group) doesn't hold up every other producer
+        mailbox = Mailbox(self, key)
+        mailbox.fsm = self._factory(key, mailbox)
+        with self._lock:
+            existing = self._mailboxes.get(key)
+            if existing is None:
+                # Initial kick of the state machine for setup, queued
+                # before the mailbox is visible to submit() so that
+                # nothing gets ahead of it
+                mailbox.put(None)
+                self._mailboxes[key] = mailbox
+                return mailbox
+
+        # Another producer got there first
+        mailbox._close()
+        mailbox.fsm.cleanup()
+        return existing
+
+    def add(self, key):
+        """Creates the machine for key (if it doesn't exist yet) and
+        returns it.
+
+        """
+        return self._mailbox(key).fsm
+
+    def submit(self, key, message):
+        """Queues a message for the machine with the given key, through
+        StateMachine.submit() so that its submit_filter_fn runs on the
+        calling thread.
+
+        """
+        return self._mailbox(key).fsm.submit(message)
+
+    def get(self, key):
+        mailbox = self._mailboxes.get(key)
+        return mailbox.fsm if mailbox else None
+
+    def __len__(self):
+        return len(self._mailboxes)
+
+    def __contains__(self, key):
+        return key in self._mailboxes
+
+    @property
+    def ready_depth(self):
+        """Number of machines waiting for a worker.
+
+        """
+        return self._ready.qsize()
+
+    @property
+    def queue_depth(self):
+        """Total number of messages waiting in all mailboxes.
+
+        """
+        return sum(mb.qsize() for mb in list(self._mailboxes.values()))
+
+    @property
+    def worker_stats(self):
+        return list(self._stats)
+
+    def close(self):
+        """Stops the worker threads once they have finished the machines
+        already scheduled. Pending messages are not processed.
+
+        """
+        for _ in self._threads:
+            self._ready.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _remove(self, mailbox):
+        with self._lock:
+            if self._mailboxes.get(mailbox.key) is mailbox:
+                del self._mailboxes[mailbox.key]
+        for item in mailbox._close():
+            self._dropped(mailbox.key, item)
+        mailbox.fsm.cleanup()
+
+    def _dropped(self, key, item):
+        # Wakeups aren't messages
+        if item is None:
+            return
+        with self._lock:
+            self.dropped += 1
+        if self._on_drop is not None:
+            self._on_drop(key, item)
+
+    def _drain(self, mailbox, stats):
+        try:
+            summary = mailbox.fsm.drain(self._batch)
+            stats.ticks += summary.messages
+            finished = summary.status is TickStatus.FINISHED
+        except StateMachineComplete:
+            finished = True
+        except Exception as e:
+            if self._on_error:
+                self._on_error(mailbox.key, mailbox.fsm, e)
+            else:
+                traceback.print_exc()
+            return True
+
+        if finished:
+            self._remove(mailbox)
+            if self._on_complete:
+                self._on_complete(mailbox.key, mailbox.fsm)
+            return False
+        return True
+
+    def _run(self, stats):
+        ready = self._ready
+        while True:
+            mailbox = ready.get()
+            if mailbox is None:
+                return
+
+            start = time.perf_counter()
+            if self._drain(mailbox, stats):
+                # Anything that arrived while we were draining (or
+                # didn't fit in the batch) goes to the back of the line
+                with mailbox._lock:
+                    if mailbox._items:
+                        ready.put(mailbox)
+                    else:
+                        mailbox._scheduled = False
+            stats.busy += time.perf_counter() - start
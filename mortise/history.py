@@ -0,0 +1,203 @@
+""" Fixed memory bookkeeping for state machine transition history.
+"""
+
+from array import array
+
+
+HISTORY_OFF = 'off'
+HISTORY_RING = 'ring'
+HISTORY_AGGREGATE = 'aggregate'
+
+HISTORY_MODES = (HISTORY_OFF, HISTORY_RING, HISTORY_AGGREGATE)
+
+
+class LogHistogram:
+    """Histogram with power-of-two buckets. Values are multiplied by
+    scale and truncated to integers before bucketing, so with the
+    default scale of 1e6 a value in seconds lands in a microsecond
+    bucket. Bucket N holds values in [2**(N-1), 2**N) scaled units.
+
+    """
+    __slots__ = ('scale', 'counts')
+
+    BUCKETS = 64
+
+    def __init__(self, scale=1e6):
+        self.scale = scale
+        self.counts = array('q', bytes(8 * self.BUCKETS))
+
+    def add(self, value):
+        idx = int(value * self.scale).bit_length()
+        if idx >= self.BUCKETS:
+            idx = self.BUCKETS - 1
+        self.counts[idx] += 1
+
+    def merge(self, other):
+        counts = self.counts
+        for idx, count in enumerate(other.counts):
+            counts[idx] += count
+
+    def percentile(self, pct):
+        """Returns the upper bound (in unscaled units) of the bucket
+        containing the given percentile, or None if empty.
+
+        """
+        total = sum(self.counts)
+        if not total:
+            return None
+        rank = total * pct / 100.0
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return (1 << idx) / self.scale
+        return (1 << (self.BUCKETS - 1)) / self.scale
+
+
+class EdgeStats:
+    """Running count/min/max/mean and a LogHistogram of the time
+    deltas recorded against a single transition edge. scale is passed
+    on to the histogram.
+
+    """
+    __slots__ = ('count', 'total', 'min', 'max', 'histogram')
+
+    def __init__(self, scale=1e6):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.histogram = LogHistogram(scale)
+
+    def add(self, delta):
+        self.count += 1
+        self.total += delta
+        if self.min is None or delta < self.min:
+            self.min = delta
+        if self.max is None or delta > self.max:
+            self.max = delta
+        self.histogram.add(delta)
+
+    def merge(self, other):
+        if not other.count:
+            return
+        self.count += other.count
+        self.total += other.total
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        self.histogram.merge(other.histogram)
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+
+class TransitionHistory:
+    """Per-machine record of transition timings whose memory does not
+    grow with the number of transitions taken.
+
+    Modes:
+
+    * HISTORY_OFF - nothing is recorded beyond the set of edges the
+      state machine keeps anyway.
+
+    * HISTORY_AGGREGATE - an EdgeStats is kept for each edge.
+
+    * HISTORY_RING - as HISTORY_AGGREGATE, and additionally the last
+      `size` (transition id, delta) pairs are kept in array-backed
+      ring storage.
+
+    """
+    def __init__(self, mode=HISTORY_AGGREGATE, size=1024):
+        if mode not in HISTORY_MODES:
+            raise ValueError("Unknown history mode: {}".format(mode))
+        if mode == HISTORY_RING and size < 1:
+            raise ValueError("Ring history size must be positive")
+
+        self.mode = mode
+        self.size = size
+        self._stats = {}
+
+        if mode == HISTORY_RING:
+            self._edges = []
+            self._edge_idx = {}
+            self._ring_edges = array('q', bytes(8 * size))
+            self._ring_ids = array('q', bytes(8 * size))
+            self._ring_deltas = array('d', bytes(8 * size))
+            self._ring_pos = 0
+            self._ring_len = 0
+
+    def record(self, trans_tup, transition_id, delta):
+        if self.mode == HISTORY_OFF:
+            return
+
+        stats = self._stats.get(trans_tup)
+        if stats is None:
+            stats = self._stats[trans_tup] = EdgeStats()
+        stats.add(delta)
+
+        if self.mode == HISTORY_RING:
+            edge_idx = self._edge_idx.get(trans_tup)
+            if edge_idx is None:
+                edge_idx = self._edge_idx[trans_tup] = len(self._edges)
+                self._edges.append(trans_tup)
+
+            pos = self._ring_pos
+            self._ring_edges[pos] = edge_idx
+            self._ring_ids[pos] = transition_id
+            self._ring_deltas[pos] = delta
+            self._ring_pos = (pos + 1) % self.size
+            if self._ring_len < self.size:
+                self._ring_len += 1
+
+    def stats(self, trans_tup):
+        """Returns the EdgeStats for an edge (None if history is off or
+        the edge was never taken).
+
+        """
+        return self._stats.get(trans_tup)
+
+    def items(self):
+        """Returns a list of (edge, EdgeStats) pairs for every edge with
+        recorded timings. Safe to call from another thread while the
+        machine is running.
+
+        """
+        return list(self._stats.items())
+
+    def recent(self, trans_tup=None):
+        """Returns the (transition id, delta) pairs still held in the
+        ring, oldest first, optionally limited to a single edge.
+
+        """
+        if self.mode != HISTORY_RING:
+            return []
+
+        edge_idx = None
+        if trans_tup is not None:
+            edge_idx = self._edge_idx.get(trans_tup)
+            if edge_idx is None:
+                return []
+
+        result = []
+        start = (self._ring_pos - self._ring_len) % self.size
+        for offset in range(self._ring_len):
+            pos = (start + offset) % self.size
+            if edge_idx is None or self._ring_edges[pos] == edge_idx:
+                result.append((self._ring_ids[pos], self._ring_deltas[pos]))
+        return result
+
+    def label(self, trans_tup):
+        """Renders the graphviz edge label for an edge from its
+        EdgeStats (kept in ring mode too), without scanning the ring.
+
+        """
+        stats = self._stats.get(trans_tup)
+        if stats is None:
+            return ""
+        return ("n={} min={:.2} mean={:.2} max={:.2}"
+                .format(stats.count, stats.min, stats.mean, stats.max))
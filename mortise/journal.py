@@ -0,0 +1,504 @@
+""" Append-only binary journal of state machine activity, and replay.
+
+A Journal attached to a StateMachine records every message passed to
+tick (before filtering) and every transition, plus the two points at
+which the outside world influences a tick: a pending timeout being
+consumed, and the tick loop yielding because more messages were
+waiting. That is enough to replay a machine deterministically, at full
+speed and without real timers.
+
+File layout (little endian):
+
+    header    magic:4s version:u16 wall_start_ns:i64
+    records   length:u32 kind:u8 timestamp_ns:i64 payload:bytes[length]
+
+Timestamps are nanoseconds since wall_start_ns, taken from a monotonic
+clock. A message the serializer can't encode is recorded as an
+UNRECORDED placeholder holding its type name, so such a journal can't
+be replayed strictly. memoryview messages (e.g. SharedRing records) are
+journaled, and replayed, as bytes.
+
+The file is grown in chunks and written through mmap; the unused tail
+is zero filled (a zero kind marks the end of the journal) and is
+truncated away on close().
+"""
+
+import collections
+import mmap
+import os
+import pickle
+import queue
+import struct
+import threading
+import time
+
+from mortise.mortise import (StateMachineComplete, BlockedInUntimedState,
+                             StateTimedOut)
+from mortise.timers import TimerBackend
+
+
+JOURNAL_MAGIC = b'MRTJ'
+JOURNAL_VERSION = 1
+
+MESSAGE = 1
+TRANSITION = 2
+TIMEOUT = 3
+YIELD = 4
+UNRECORDED = 5
+
+_FILE_HEADER = struct.Struct('<4sHq')
+_RECORD = struct.Struct('<IBq')
+_NAME_LEN = struct.Struct('<H')
+
+JournalRecord = collections.namedtuple('JournalRecord',
+                                       ['kind', 'timestamp', 'value'])
+
+
+class JournalError(Exception):
+    pass
+
+
+class ReplayDivergedError(JournalError):
+    pass
+
+
+def _pack_names(cur_name, next_name):
+    cur = cur_name.encode()
+    nxt = next_name.encode()
+    return b''.join([_NAME_LEN.pack(len(cur)), cur,
+                     _NAME_LEN.pack(len(nxt)), nxt])
+
+
+def _unpack_names(payload):
+    (cur_len,) = _NAME_LEN.unpack_from(payload, 0)
+    offset = _NAME_LEN.size
+    cur = bytes(payload[offset:offset + cur_len]).decode()
+    offset += cur_len
+    (next_len,) = _NAME_LEN.unpack_from(payload, offset)
+    offset += _NAME_LEN.size
+    return cur, bytes(payload[offset:offset + next_len]).decode()
+
+
+def _scan(buf, offset):
+    """Yields (offset, kind, timestamp, payload view) for each record
+    from offset up to the end marker.
+
+    """
+    end = len(buf)
+    while offset + _RECORD.size <= end:
+        length, kind, timestamp = _RECORD.unpack_from(buf, offset)
+        if kind == 0:
+            return
+        start = offset + _RECORD.size
+        if start + length > end:
+            raise JournalError("Truncated record at offset {}".format(offset))
+        yield offset, kind, timestamp, buf[start:start + length]
+        offset = start + length
+
+
+class Journal:
+    """Append-only journal file, written through mmap.
+
+    Records are buffered in memory and committed to the mapping as a
+    group, once batch_records records are pending, and otherwise by a
+    background thread commit_interval seconds after the first of them
+    was recorded. A crash of the process therefore loses at most the
+    records of the last commit_interval seconds (with commit_interval
+    None there is no thread, and records are only committed in full
+    batches and on commit() or close()). With sync=True every commit is
+    also msync'ed to disk; otherwise a commit survives a crash of the
+    process but not of the machine.
+
+    Opening an existing journal appends to it. A journal should only be
+    written by one state machine at a time.
+
+    """
+    def __init__(self, path, serializer=pickle, batch_records=256,
+                 commit_interval=0.05, sync=False, chunk_size=1 << 20):
+        self.path = path
+        self._serializer = serializer
+        self._batch_records = batch_records
+        self._commit_interval = commit_interval
+        self._sync = sync
+        self._chunk_size = chunk_size
+
+        self._pending = []
+        self._first_pending_ns = None
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self._file = open(path, 'r+b' if exists else 'w+b')
+        if exists:
+            self._map = mmap.mmap(self._file.fileno(), 0)
+            magic, version, self.wall_start_ns = \
+                _FILE_HEADER.unpack_from(self._map, 0)
+            if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION:
+                raise JournalError("{} is not a mortise journal".format(path))
+            self._offset = _FILE_HEADER.size
+            for offset, _, _, payload in _scan(self._map, self._offset):
+                self._offset = offset + _RECORD.size + len(payload)
+        else:
+            self.wall_start_ns = time.time_ns()
+            self._file.truncate(chunk_size)
+            self._map = mmap.mmap(self._file.fileno(), 0)
+            _FILE_HEADER.pack_into(self._map, 0, JOURNAL_MAGIC,
+                                   JOURNAL_VERSION, self.wall_start_ns)
+            self._offset = _FILE_HEADER.size
+
+        # Map the monotonic clock onto the journal's wall clock start
+        self._mono_base_ns = (time.monotonic_ns() -
+                              (time.time_ns() - self.wall_start_ns))
+
+        if commit_interval is not None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='mortise-journal',
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        # Commits whatever has been pending for commit_interval
+        interval_ns = int(self._commit_interval * 1e9)
+        with self._cond:
+            while self._map is not None:
+                first = self._first_pending_ns
+                if first is None:
+                    self._cond.wait()
+                    continue
+                remaining = first + interval_ns - time.monotonic_ns()
+                if remaining > 0:
+                    self._cond.wait(remaining / 1e9)
+                    continue
+                self._commit()
+
+    def _append(self, kind, payload):
+        now = time.monotonic_ns()
+        record = _RECORD.pack(len(payload), kind, now - self._mono_base_ns)
+        with self._cond:
+            self._pending.append(record)
+            self._pending.append(payload)
+
+            if self._first_pending_ns is None:
+                self._first_pending_ns = now
+                # Start the commit thread's countdown
+                self._cond.notify()
+            if len(self._pending) >= 2 * self._batch_records:
+                self._commit()
+
+    def record_message(self, message):
+        """Records a message, and returns None, or the exception the
+        serializer raised for it if only a placeholder was recorded.
+
+        """
+        if isinstance(message, memoryview):
+            # Only valid during the tick, and not picklable
+            message = bytes(message)
+        try:
+            payload = self._serializer.dumps(message)
+        except Exception as e:
+            self._append(UNRECORDED,
+                         type(message).__qualname__.encode())
+            return e
+        self._append(MESSAGE, payload)
+        return None
+
+    def record_transition(self, cur_name, next_name):
+        self._append(TRANSITION, _pack_names(cur_name, next_name))
+
+    def record_timeout(self):
+        self._append(TIMEOUT, b'')
+
+    def record_yield(self):
+        self._append(YIELD, b'')
+
+    def commit(self):
+        """Writes all pending records to the mapping.
+
+        """
+        with self._cond:
+            self._commit()
+
+    def _commit(self):
+        if not self._pending:
+            return
+        data = b''.join(self._pending)
+        self._pending = []
+        self._first_pending_ns = None
+
+        end = self._offset + len(data)
+        if end + _RECORD.size > len(self._map):
+            self._grow(end + _RECORD.size)
+
+        self._map[self._offset:end] = data
+        self._offset = end
+        if self._sync:
+            self._map.flush()
+
+    def _grow(self, needed):
+        size = len(self._map)
+        while size < needed:
+            size += max(self._chunk_size, min(size, 64 << 20))
+        self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+    def close(self):
+        """Commits pending records and truncates the file to its
+        contents.
+
+        """
+        with self._cond:
+            if self._map is None:
+                return
+            self._commit()
+            self._map.flush()
+            self._map.close()
+            self._map = None
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self._file.truncate(self._offset)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class JournalReader:
+    """Iterates over the JournalRecords in a journal file. Message
+    payloads are decoded with serializer, transitions are returned as
+    (from name, to name) tuples.
+
+    """
+    def __init__(self, path, serializer=pickle):
+        self.path = path
+        self._serializer = serializer
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.wall_start_ns = \
+            _FILE_HEADER.unpack_from(self._map, 0)
+        if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION:
+            raise JournalError("{} is not a mortise journal".format(path))
+
+    def __iter__(self):
+        loads = self._serializer.loads
+        for _, kind, timestamp, payload in _scan(self._map,
+                                                 _FILE_HEADER.size):
+            if kind == MESSAGE:
+                value = loads(payload)
+            elif kind == TRANSITION:
+                value = _unpack_names(payload)
+            elif kind == UNRECORDED:
+                value = bytes(payload).decode()
+            else:
+                value = None
+            yield JournalRecord(kind, timestamp, value)
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _ReplayCursor:
+    """Walks the journal records alongside the replaying machine. The
+    machine's own journal calls consume the records it would have
+    written, which keeps the replay in lockstep with the recording.
+
+    """
+    def __init__(self, records, strict):
+        self._records = records
+        self._strict = strict
+        self.pos = 0
+
+    def peek_kind(self):
+        if self.pos < len(self._records):
+            return self._records[self.pos].kind
+        return None
+
+    def clock(self):
+        """Replay clock: the timestamp of the record about to be
+        consumed, so that a transition reads the time it was recorded
+        at.
+
+        """
+        records = self._records
+        if self.pos < len(records):
+            return records[self.pos].timestamp
+        return records[-1].timestamp if records else 0
+
+    def _consume(self, kind, value=None):
+        if self.peek_kind() == kind:
+            record = self._records[self.pos]
+            self.pos += 1
+            if (self._strict and kind == TRANSITION and
+                    record.value != value):
+                raise ReplayDivergedError(
+                    "Replay took {} -> {} where the journal has {} -> {}"
+                    .format(value[0], value[1], *record.value))
+        elif self._strict:
+            raise ReplayDivergedError(
+                "Replay produced record kind {} at position {}, journal "
+                "has kind {}".format(kind, self.pos, self.peek_kind()))
+
+    # Journal interface, used by the replaying machine
+    def record_message(self, message):
+        self._consume(MESSAGE)
+
+    def record_transition(self, cur_name, next_name):
+        self._consume(TRANSITION, (cur_name, next_name))
+
+    def record_timeout(self):
+        self._consume(TIMEOUT)
+
+    def record_yield(self):
+        self._consume(YIELD)
+
+
+class _ReplayTimeouts:
+    """Stands in for the machine's timeout queue: a timeout is pending
+    exactly when the next journal record says one was consumed.
+
+    """
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def append(self, item):
+        pass
+
+    def __len__(self):
+        return 1 if self._cursor.peek_kind() == TIMEOUT else 0
+
+    def popleft(self):
+        return StateTimedOut("Replayed timeout")
+
+
+class _ReplayQueue:
+    """Stands in for the machine's msg_queue: messages come from the
+    journal, and the queue only looks non-empty where the recorded
+    tick yielded to a waiting message.
+
+    """
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def put(self, item, block=True, timeout=None):
+        pass
+
+    put_nowait = put
+
+    def get(self, block=True, timeout=None):
+        raise queue.Empty
+
+    get_nowait = get
+
+    def empty(self):
+        return self._cursor.peek_kind() != YIELD
+
+    def qsize(self):
+        return 0
+
+
+class _ReplayTimerBackend(TimerBackend):
+    """Timers never fire during a replay, timeouts come from the
+    journal instead.
+
+    """
+    def _arm(self, handle):
+        handle._entry = True
+        handle.deadline = 0.0
+        self._armed += 1
+
+    def _cancel(self, handle):
+        handle._entry = None
+        self._armed -= 1
+
+    def remaining(self, handle):
+        return None
+
+
+def replay(path, fsm, serializer=pickle, strict=True):
+    """Rebuilds fsm (a freshly constructed machine with the same
+    configuration as the one that wrote the journal) by feeding it the
+    recorded messages as fast as possible. Timeouts are taken from the
+    journal rather than from timers, and the machine's clock reads the
+    recorded timestamps, so its history shows the original transition
+    times. State handlers run as usual.
+
+    With strict=True a ReplayDivergedError is raised as soon as the
+    replay takes a different path than the recording (e.g. because a
+    handler depends on something other than its messages).
+
+    Returns the number of messages replayed. Afterwards the machine's
+    own queues and timers are put back; if the current state has a
+    TIMEOUT, its timer is restarted from scratch.
+
+    """
+    with JournalReader(path, serializer) as reader:
+        records = list(reader)
+
+    # Transitions recorded before the first message come from the
+    # original machine's construction, which fsm has already done
+    start = 0
+    while start < len(records) and records[start].kind == TRANSITION:
+        start += 1
+
+    cursor = _ReplayCursor(records[start:], strict)
+    saved = (fsm._msg_queue, fsm._timeout_queue, fsm._timers, fsm._journal,
+             fsm._clock, fsm._coalesce_fn)
+    fsm._msg_queue = _ReplayQueue(cursor)
+    fsm._timeout_queue = _ReplayTimeouts(cursor)
+    fsm._timers = _ReplayTimerBackend()
+    fsm._journal = cursor
+    fsm._clock = cursor.clock
+    # The machine's own queue isn't the one being replayed from
+    fsm._coalesce_fn = None
+    # Time the first replayed transition from the construction one
+    if start:
+        fsm._last_trans_ns = records[start - 1].timestamp
+    else:
+        fsm._last_trans_ns = cursor.clock()
+
+    count = 0
+    try:
+        while cursor.pos < len(cursor._records):
+            record = cursor._records[cursor.pos]
+            if record.kind == UNRECORDED:
+                if strict:
+                    raise ReplayDivergedError(
+                        "Message at position {} ({}) couldn't be journaled"
+                        .format(cursor.pos, record.value))
+                cursor.pos += 1
+                continue
+            if record.kind != MESSAGE:
+                if strict:
+                    raise ReplayDivergedError(
+                        "Replay expected a message at position {}, journal "
+                        "has kind {}".format(cursor.pos, record.kind))
+                cursor.pos += 1
+                continue
+
+            count += 1
+            try:
+                fsm.tick(record.value)
+            except (BlockedInUntimedState, StateMachineComplete):
+                pass
+    finally:
+        (fsm._msg_queue, fsm._timeout_queue, fsm._timers,
+         fsm._journal, fsm._clock, fsm._coalesce_fn) = saved
+        fsm._last_trans_ns = fsm._clock()
+
+    current = fsm._current
+    if current._failsafe_timer is not None:
+        current._failsafe_timer = None
+        if current.has_entered and current.TIMEOUT:
+            current._start_failsafe(fsm._shared_state)
+
+    return count
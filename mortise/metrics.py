@@ -0,0 +1,229 @@
+""" Per-machine counters and gauges, exposed in Prometheus text format.
+
+Counters are plain integers bumped where the event happens, with no
+locking: each is only ever written from the thread ticking the machine
+(timeouts are counted when a tick consumes them, not by the timer). The
+exception is submit_filtered, counted on whichever threads call
+submit(), which takes a lock, but only for messages submit_filter_fn
+drops.
+
+Everything that can be derived from what the machine keeps anyway
+(transitions per edge and time in state from its history, queue depth
+and drops from its msg_queue) is only read when the metrics are
+rendered, and costs nothing while the machine runs.
+"""
+
+import http.server
+import io
+import os
+import threading
+
+
+# (attribute, metric name, help) for each MachineMetrics counter
+COUNTERS = (
+    ('messages', 'messages_total', "Messages ticked."),
+    ('filtered', 'filtered_total', "Messages dropped by filter_fn."),
+    ('submit_filtered', 'submit_filtered_total',
+     "Messages dropped by submit_filter_fn before being queued."),
+    ('trapped', 'trapped_total',
+     "Messages no state handled (returned None for, or not in HANDLES)."),
+    ('timeouts', 'timeouts_total', "State timeouts fired."),
+    ('retry_limits', 'retry_limits_total',
+     "States that exhausted their RETRIES."),
+    ('blocked', 'blocked_untimed_total',
+     "Ticks that ended in BlockedInUntimedState."),
+)
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def _labels(labels):
+    return "{{{}}}".format(",".join(
+        '{}="{}"'.format(key, _escape(value)) for key, value in labels))
+
+
+class MachineMetrics:
+    """Counters for a single state machine, passed to it as metrics=.
+    labels (a dict) identify the machine in the rendered output; a
+    registry adds a machine label.
+
+    Transition counts per edge and time spent in each state (up to the
+    last transition out of it) come from the machine's history, so they
+    are missing with HISTORY_OFF.
+
+    """
+    __slots__ = ('labels', 'fsm', 'messages', 'filtered', 'submit_filtered',
+                 'trapped', 'timeouts', 'retry_limits', 'blocked',
+                 '_submit_lock')
+
+    def __init__(self, labels=None):
+        self.labels = tuple(sorted((labels or {}).items()))
+        self.fsm = None
+        self._submit_lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        for attr, _, _ in COUNTERS:
+            setattr(self, attr, 0)
+
+    def count_submit_filtered(self):
+        """Called by submit() for each message submit_filter_fn drops,
+        from any thread.
+
+        """
+        with self._submit_lock:
+            self.submit_filtered += 1
+
+    def bind(self, fsm):
+        """Called by the state machine that the metrics are passed to.
+
+        """
+        self.fsm = fsm
+
+    def edges(self):
+        """Returns [((from, to), count, seconds)] for every edge in the
+        machine's history.
+
+        """
+        fsm = self.fsm
+        if fsm is None:
+            return []
+        return [((edge[1], edge[3]), stats.count, stats.total)
+                for edge, stats in fsm.history.items()]
+
+    def samples(self):
+        """Yields (metric name, extra labels, value) for every sample,
+        counters first, in the order render() groups them by.
+
+        """
+        for attr, name, _ in COUNTERS:
+            yield name, (), getattr(self, attr)
+
+        fsm = self.fsm
+        if fsm is None:
+            return
+
+        state_seconds = {}
+        for (first, second), count, seconds in self.edges():
+            yield 'transitions_total', (('from', first), ('to', second)), count
+            state_seconds[first] = state_seconds.get(first, 0.0) + seconds
+        for state, seconds in state_seconds.items():
+            yield 'state_seconds_total', (('state', state),), seconds
+
+        msg_queue = fsm.msg_queue
+        yield 'queue_depth', (), msg_queue.qsize()
+        dropped = getattr(msg_queue, 'dropped', None)
+        if dropped is not None:
+            yield 'queue_dropped_total', (), dropped
+
+
+METRICS = tuple((name, 'counter', doc) for _, name, doc in COUNTERS) + (
+    ('transitions_total', 'counter', "Transitions taken, per edge."),
+    ('state_seconds_total', 'counter',
+     "Seconds spent in each state before leaving it."),
+    ('queue_depth', 'gauge', "Messages waiting in msg_queue."),
+    ('queue_dropped_total', 'counter',
+     "Messages dropped by msg_queue (overflow or coalescing)."),
+)
+
+
+class MetricsRegistry:
+    """Collection of MachineMetrics rendered together, with metric
+    names prefixed by prefix.
+
+    Machines are added with machine(name, **labels), which returns the
+    MachineMetrics to pass to the state machine, e.g.
+
+        registry = MetricsRegistry()
+        fsm = StateMachine(..., metrics=registry.machine('door-3'))
+        registry.write('/var/lib/node_exporter/mortise.prom')
+
+    """
+    def __init__(self, prefix='mortise'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._machines = []
+
+    def machine(self, name, **labels):
+        labels['machine'] = name
+        return self.add(MachineMetrics(labels))
+
+    def add(self, metrics):
+        with self._lock:
+            self._machines.append(metrics)
+        return metrics
+
+    def remove(self, metrics):
+        with self._lock:
+            self._machines.remove(metrics)
+
+    def render(self, fp=None):
+        """Writes the Prometheus text exposition of every machine to fp,
+        or returns it as a string.
+
+        """
+        if fp is None:
+            buf = io.StringIO()
+            self.render(buf)
+            return buf.getvalue()
+
+        with self._lock:
+            machines = list(self._machines)
+
+        samples = {}
+        for metrics in machines:
+            for name, labels, value in metrics.samples():
+                samples.setdefault(name, []).append(
+                    (metrics.labels + labels, value))
+
+        for name, kind, doc in METRICS:
+            rows = samples.get(name)
+            if not rows:
+                continue
+            full_name = "{}_{}".format(self.prefix, name)
+            fp.write("# HELP {} {}\n".format(full_name, doc))
+            fp.write("# TYPE {} {}\n".format(full_name, kind))
+            for labels, value in rows:
+                fp.write("{}{} {}\n".format(
+                    full_name, _labels(labels) if labels else "", value))
+
+    def write(self, path):
+        """Renders to a file, atomically replacing it (as expected by the
+        node_exporter textfile collector).
+
+        """
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, 'w') as fp:
+            self.render(fp)
+        os.replace(tmp_path, path)
+
+    def serve(self, port=0, host='127.0.0.1'):
+        """Serves the metrics over HTTP for scraping, from a daemon
+        thread. Returns the server; server.server_address has the port
+        actually bound and server.shutdown() stops it.
+
+        """
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever,
+                                  name='mortise-metrics', daemon=True)
+        thread.start()
+        return server
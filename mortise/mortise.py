@@ -2,14 +2,55 @@
 """ mortise is a finite state machine library.
 """
 
-from threading import Timer
 import collections
-from datetime import datetime
-from queue import Queue
+import io
+import pickle
+import selectors
+import socket
+import sys
+from queue import Queue, Empty, Full
+from time import perf_counter_ns
+
+from mortise.events import (LogEvent, LogFnSink, INFO, WARNING,
+                            TRANSITION, STALE_TIMEOUT, UNRECORDED_MESSAGE)
+from mortise.history import TransitionHistory, HISTORY_AGGREGATE
+from mortise.queues import DequeQueue, BLOCK
+from mortise.metrics import MachineMetrics
+from mortise import snapshot
+from mortise.clock import monotonic_clock
+from mortise.timers import (TimerBackend, InlineTimerBackend,
+                            default_timer_backend)
+from mortise.timing import (HandlerTiming, ON_ENTER, ON_STATE, ON_LEAVE,
+                            ON_TIMEOUT, ON_FAIL)
 
 
 BLOCKING_RETURNS = [None, True]
 
+# Returned by StateMachine.tick_many/drain. status is only set in
+# tick_status mode
+TickSummary = collections.namedtuple('TickSummary',
+                                     ['messages', 'filtered', 'transitions',
+                                      'status'])
+TickSummary.__new__.__defaults__ = (None,)
+
+
+class TickStatus:
+    """Outcomes returned by tick() in tick_status mode, instead of
+    raising StateMachineComplete or BlockedInUntimedState.
+
+    """
+    # Waiting for the next message, without having transitioned
+    WAITING = 'waiting'
+    # Took at least one transition and is now waiting
+    TRANSITIONED = 'transitioned'
+    # The message was dropped by filter_fn
+    FILTERED = 'filtered'
+    # Reached the final state
+    FINISHED = 'finished'
+    # Stopped in a state with neither a TIMEOUT nor dwelling allowed,
+    # with nothing queued to move it along
+    BLOCKED_UNTIMED = 'blocked-untimed'
+
 
 class StateRetryLimitError(Exception):
     pass
@@ -43,6 +84,32 @@ class NonBlockingStalled(Exception):
     pass
 
 
+class UndeclaredTransitionError(Exception):
+    pass
+
+
+class InvalidTransitionsError(TypeError):
+    pass
+
+
+class SubmitFilterError(Exception):
+    """Carries an exception raised by a submit_filter_fn (on the
+    producer's thread) through the message queue, so that the consumer
+    can hand it to on_error_fn.
+
+    """
+    def __init__(self, message, error):
+        super().__init__(message, error)
+
+    @property
+    def message(self):
+        return self.args[0]
+
+    @property
+    def error(self):
+        return self.args[1]
+
+
 class BlockedInUntimedState(Exception):
     def __init__(self, state):
         super().__init__("Blocking on state without a timer: {}"
@@ -51,14 +118,67 @@ class BlockedInUntimedState(Exception):
 
 
 class Push(object):
+    __slots__ = ('push_states', 'name')
+
     def __init__(self, *args):
         self.push_states = args
         self.name = 'Push'
 
+    # Pushes compare by their states so that they can be declared in
+    # State.TRANSITIONS
+    def __eq__(self, other):
+        return (isinstance(other, Push) and
+                self.push_states == other.push_states)
+
+    def __hash__(self):
+        return hash(self.push_states)
+
+    def __repr__(self):
+        return "Push({})".format(", ".join(state_name(state)
+                                           for state in self.push_states))
+
 Pop = collections.namedtuple('Pop', [])
 
 
+class StateMeta:
+    """Metadata about a State class that the state machine needs on
+    every tick/transition. It is computed once when the class is
+    created (see State.__init_subclass__) so that the hot paths don't
+    need to reflect on the class.
+
+    timeout and retries are the class defaults at definition time,
+    states still read self.TIMEOUT/self.RETRIES so that instances may
+    override them.
+
+    """
+    __slots__ = ('name', 'base_name', 'has_on_state', 'timeout', 'retries',
+                 'reusable', 'transitions', 'declared', 'handles',
+                 'coalesce')
+
+    def __init__(self, cls):
+        self.name = cls.__name__
+        self.base_name = cls.__bases__[0].__name__
+        self.has_on_state = hasattr(cls, 'on_state')
+        self.timeout = getattr(cls, 'TIMEOUT', None)
+        self.retries = getattr(cls, 'RETRIES', None)
+        self.reusable = getattr(cls, 'REUSABLE', False)
+        # Resolved lazily by declared_transitions(), since TRANSITIONS
+        # may name states that don't exist yet
+        self.transitions = getattr(cls, 'TRANSITIONS', None)
+        self.declared = None
+        handles = getattr(cls, 'HANDLES', None)
+        self.handles = frozenset(handles) if handles is not None else None
+        coalesce = getattr(cls, 'COALESCE', None)
+        if coalesce is not None and coalesce is not True:
+            coalesce = frozenset(coalesce)
+        self.coalesce = coalesce
+
+
 def state_name(descriptor):
+    meta = getattr(descriptor, '_mortise_meta', None)
+    if meta is not None:
+        return meta.name
+
     if hasattr(descriptor, '__name__'):
         return descriptor.__name__
     elif hasattr(descriptor, 'name'):
@@ -66,12 +186,118 @@ def state_name(descriptor):
 
 
 def base_state_name(descriptor):
+    meta = getattr(descriptor, '_mortise_meta', None)
+    if meta is not None:
+        return meta.base_name
+
     if hasattr(descriptor, '__bases__'):
         return descriptor.__bases__[0].__name__
     elif hasattr(descriptor, '__class__'):
         return descriptor.__class__.__bases__[0].__name__
 
 
+def _resolve_ref(cls, ref):
+    if ':' in ref:
+        try:
+            return snapshot.resolve_state(ref.encode())
+        except snapshot.SnapshotError as e:
+            raise InvalidTransitionsError(str(e))
+
+    # Look the name up in the declaring module, then in each of the
+    # classes the declaring class is nested in
+    module = sys.modules.get(cls.__module__)
+    scopes = [module]
+    for attr in cls.__qualname__.split('.')[:-1]:
+        scopes.append(getattr(scopes[-1], attr, None))
+
+    for scope in reversed(scopes):
+        target = scope
+        for attr in ref.split('.'):
+            target = getattr(target, attr, None)
+        if target is not None:
+            return target
+
+    raise InvalidTransitionsError(
+        "State {} declares a transition to unknown state {}"
+        .format(cls.__name__, ref))
+
+
+def _resolve_transition(cls, transition):
+    if isinstance(transition, str):
+        transition = _resolve_ref(cls, transition)
+    elif isinstance(transition, Push):
+        return Push(*[_resolve_transition(cls, state)
+                      for state in transition.push_states])
+
+    if transition is Pop or (isinstance(transition, type) and
+                             issubclass(transition, State)):
+        return transition
+    raise InvalidTransitionsError(
+        "State {} declares an invalid transition: {!r}"
+        .format(cls.__name__, transition))
+
+
+def declared_transitions(cls):
+    """Returns the frozenset of transitions (state classes, Push
+    instances and Pop) that a state class declares in TRANSITIONS, with
+    names resolved, or None if it doesn't declare any.
+
+    """
+    meta = cls._mortise_meta
+    if meta.declared is None and meta.transitions is not None:
+        meta.declared = frozenset(_resolve_transition(cls, transition)
+                                  for transition in meta.transitions)
+    return meta.declared
+
+
+# (initial, final, error, dwell states) -> transition table, shared by
+# all machines with the same configuration
+_transition_tables = {}
+
+
+def _state_record(state, final_state, error_state, dwell_states):
+    declared = declared_transitions(state)
+    if declared is not None:
+        # Timeouts and failures may always lead to the error state
+        declared = declared | {error_state}
+    return (issubclass(state, final_state),
+            any(issubclass(state, d_state) for d_state in dwell_states),
+            declared)
+
+
+def transition_table(initial_state, final_state, error_state,
+                     dwell_states=()):
+    """Returns the transition table for a machine configuration: a dict
+    of state class -> (is_final, is_dwell, allowed transitions or None)
+    holding every state reachable through declared TRANSITIONS. The
+    table is shared and never changes once built: states that are only
+    discovered at runtime are kept by each machine separately.
+
+    """
+    dwell_states = tuple(dwell_states)
+    key = (initial_state, final_state, error_state, dwell_states)
+    table = _transition_tables.get(key)
+    if table is not None:
+        return table
+
+    table = {}
+    todo = [initial_state, error_state, final_state]
+    while todo:
+        state = todo.pop()
+        if state in table:
+            continue
+        record = table[state] = _state_record(state, final_state,
+                                              error_state, dwell_states)
+        for target in record[2] or ():
+            if isinstance(target, Push):
+                todo.extend(target.push_states)
+            elif target is not Pop:
+                todo.append(target)
+
+    _transition_tables[key] = table
+    return table
+
+
 class State:
     """States are the workhorses of the mortise library. User states
     should inherit from State and provide
@@ -110,7 +336,8 @@ class State:
     transition. The FSM will fire the current on_leave handler (if
     it exists) and transition to the next state.
 
-    States may also provide TIMEOUT and RETRIES class variables.
+    States may also provide TIMEOUT, RETRIES, TRANSITIONS, HANDLES and
+    COALESCE class variables.
 
     TIMEOUT specifies the duration of a failsafe timer in seconds that
     is started when a state is entered, and cancelled when a state
@@ -127,15 +354,59 @@ class State:
     machine's default error state to be entered, or the descriptor of
     a specific error state may be returned.
 
+    TRANSITIONS optionally declares every state the state may return,
+    e.g. (Ready, Push(Calibrate, Ready), Pop). States that have not
+    been defined yet may be named by a string: either the name of a
+    class in the state's module (or enclosing class), or a
+    "module:qualname" reference. Returning anything undeclared raises
+    UndeclaredTransitionError. A state can always retry itself and go
+    to the machine's default error state. States without TRANSITIONS
+    may return anything.
+
+    HANDLES optionally lists the message keys (as computed by the
+    machine's message_key_fn) that on_state cares about. Once the state
+    has been entered, any other message goes straight to the trap_fn
+    (or is dropped if there is none) without calling on_state, unless a
+    timeout is pending. Without a message_key_fn HANDLES is ignored.
+
+    COALESCE (True, or a collection of message keys) asks a
+    mortise.queues.CoalescingQueue to keep only the latest queued
+    message per key (for all keys, or just those listed) while the
+    state is current. Other queues ignore it.
+
+    The framework's own bookkeeping lives in __slots__. States that keep
+    no instance data of their own may declare `__slots__ = ()` to drop
+    the per-instance __dict__ entirely.
+
+    When a StateMachine is created with reuse_states=True, it keeps one
+    instance per state class and resets it with _reset() on each entry
+    instead of allocating a new one. States that rely on a fresh
+    instance (e.g. that only set attributes conditionally) must set
+    REUSABLE = False to opt out.
+
+    _timing is set by the state machine when handler timing is enabled
+    (see mortise.timing), otherwise it is None.
+
     """
+    __slots__ = ('_tries', '_failsafe_timer', 'has_entered', '_timing')
+
     # TIMEOUT and RETRIES can and should be overridden by child
     # classes that require either of these bits of functionality
     TIMEOUT = None
     RETRIES = None
+    TRANSITIONS = None
+    HANDLES = None
+    COALESCE = None
+    REUSABLE = True
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._mortise_meta = StateMeta(cls)
 
     def __init__(self):
         self._tries = None
         self._failsafe_timer = None
+        self._timing = None
         self._reset()
 
     def _reset(self):
@@ -164,6 +435,8 @@ class State:
             self._failsafe_timer = None
 
     def _start_failsafe(self, evt):
+        # The FSM hands back an unarmed timer handle from its timer
+        # backend (threading.Timer compatible start/cancel interface)
         self._failsafe_timer = evt.fsm.start_failsafe_timer(self.TIMEOUT)
         self._failsafe_timer.start()
 
@@ -183,29 +456,46 @@ class State:
             self._cancel_failsafe()
             self._start_failsafe(evt)
 
+    def _timed(self, handler, fn, evt):
+        start = perf_counter_ns()
+        try:
+            return fn(evt)
+        finally:
+            self._timing.record(self, handler, start,
+                                perf_counter_ns() - start)
+
     def _wrap_enter(self, evt, fn=None):
         self._handle_retries()
 
         if fn:
-            fn(evt)
+            if self._timing is None:
+                fn(evt)
+            else:
+                self._timed(ON_ENTER, fn, evt)
 
         self._maybe_failsafe_timer(evt)
         self.has_entered = True
 
     def _wrap_leave(self, evt, fn=None):
         if fn:
-            fn(evt)
+            if self._timing is None:
+                fn(evt)
+            else:
+                self._timed(ON_LEAVE, fn, evt)
         self._reset()
 
     def _handle_timeout(self, shared_state):
-        result = self.on_timeout(shared_state)
+        if self._timing is None:
+            result = self.on_timeout(shared_state)
+        else:
+            result = self._timed(ON_TIMEOUT, self.on_timeout, shared_state)
         if not result:
             result = shared_state.fsm._err_st
 
         # If we return ourselves from a timeout, this means that this
         # is a 'self ticking' state and we need to check our retries
         # and reset our timer
-        if result is not None and state_name(result) == self.name:
+        if result is self or result is self.__class__:
             self.has_entered = False
             # Make sure that our timer is cancelled (in case out of order)
             self._cancel_failsafe()
@@ -221,7 +511,10 @@ class State:
             result = self._handle_timeout(shared_state)
             return result
         elif isinstance(shared_state.msg, StateRetryLimitError):
-            result = self.on_fail(shared_state)
+            if self._timing is None:
+                result = self.on_fail(shared_state)
+            else:
+                result = self._timed(ON_FAIL, self.on_fail, shared_state)
             if not result:
                 result = shared_state.fsm._err_st
             return result
@@ -237,7 +530,7 @@ class State:
 
             # If a State intentionally returns itself, this is a retry and
             # we should re-enter on the next tick
-            if state_name(result) == self.name:
+            if result is self or result is self.__class__:
                 self.has_entered = False
                 self._cancel_failsafe()
                 return result
@@ -249,14 +542,16 @@ class State:
 
     @property
     def name(self):
-        return self.__class__.__name__
+        return self._mortise_meta.name
 
     def on_enter_handler(self, evt):
         return self._wrap_enter(evt, self.on_enter)
 
     def on_state_handler(self, evt):
-        if hasattr(self, 'on_state'):
-            return self.on_state(evt)
+        if self._mortise_meta.has_on_state:
+            if self._timing is None:
+                return self.on_state(evt)
+            return self._timed(ON_STATE, self.on_state, evt)
         else:
             raise MissingOnStateHandler(
                 "State {} has no on_state handler!"
@@ -267,9 +562,14 @@ class State:
         return self._wrap_leave(evt, self.on_leave)
 
 
+State._mortise_meta = StateMeta(State)
+
+
 # End is a default state that any FSM can use
 class DefaultStates:
     class End(State):
+        __slots__ = ()
+
         def on_state(self, evt):
             pass
 
@@ -277,11 +577,45 @@ class DefaultStates:
 class GenericCommon:
     """This is an empty container class to hold any carry-over state in
     between FSM states should the user not provide a state container.
+    (It is deliberately dict-backed, since states may store anything
+    on it.)
 
     """
     pass
 
 
+class _Waker:
+    """Socket pair that other threads write to in order to wake a
+    StateMachine.run() loop waiting in select().
+
+    """
+    def __init__(self):
+        self._recv, self._send = socket.socketpair()
+        self._recv.setblocking(False)
+        self._send.setblocking(False)
+
+    def fileno(self):
+        return self._recv.fileno()
+
+    def wake(self):
+        try:
+            self._send.send(b'\0')
+        except (BlockingIOError, OSError):
+            # Already plenty of wakeups pending (or closed)
+            pass
+
+    def drain(self):
+        try:
+            while self._recv.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def close(self):
+        self._recv.close()
+        self._send.close()
+
+
 class SharedState:
     """SharedState is passed to each state to allow states to share
     information downstream. The shared state object contains a
@@ -290,8 +624,11 @@ class SharedState:
     supplied during state machine instantiation.
 
     """
+    __slots__ = ('fsm', 'common', 'msg')
+
     def __init__(self, fsm, common_state):
         self.fsm = fsm
+        self.msg = None
 
         if not common_state:
             self.common = GenericCommon()
@@ -308,7 +645,11 @@ class StateMachine:
     Additionally, the user MAY supply a Queue object (msg_queue) which will be
     used to pass messages into states (and relay information about timeouts and
     retry failures between the states and FSM). If no msg_queue is provided
-    a default queue.Queue().empty() is used.
+    a default queue.Queue().empty() is used. See mortise.queues for
+    cheaper alternatives; on a queue with a priority lane, timeouts and
+    retry failures are delivered ahead of any queued messages. Given a
+    queue_capacity (and no msg_queue), the machine uses a DequeQueue of
+    that size with the given overflow policy (see mortise.queues).
 
     The user MAY supply filter and trap functions. filter allows the
     user to pre-screen messages that may be important to the state
@@ -327,6 +668,70 @@ class StateMachine:
     information between states. If no common_state class is provided,
     an empty 'GenericCommon' will be provided (which is simply an empty class)
 
+    State timeouts are armed on a timer_backend (see mortise.timers). By
+    default all state machines in a process share a single timer
+    thread; pass ThreadTimerBackend() to get the old one-thread-per-timer
+    behavior.
+
+    Transition timings are kept according to history (see
+    mortise.history): HISTORY_AGGREGATE (the default) keeps per-edge
+    statistics, HISTORY_RING additionally keeps the last history_size
+    transitions, and HISTORY_OFF only records which edges were taken.
+
+    With reuse_states=True each machine keeps a single instance of
+    every (REUSABLE) state class it visits rather than creating a new
+    one per transition.
+
+    A running machine can be captured with snapshot() and resumed
+    (possibly in another process) with restore(). The common state is
+    encoded with serializer, any object with dumps/loads (pickle by
+    default).
+
+    If a journal (mortise.journal.Journal) is given, every message,
+    transition, consumed timeout and tick yield is appended to it, so
+    that the machine can later be rebuilt with mortise.journal.replay.
+    A message its serializer can't encode is journaled as a placeholder
+    (and reported to the event sink), and breaks a strict replay.
+
+    Transition times are taken from clock, a callable returning
+    monotonic nanoseconds (time.monotonic_ns by default). Given a
+    mortise.clock.VirtualClock and no timer_backend, the clock also
+    drives the state timeouts, which then only expire when the clock is
+    advanced.
+
+    Messages may be put on msg_queue directly or handed to submit(),
+    which first runs submit_filter_fn(message) (if given) on the
+    calling thread. Messages for which it returns True are dropped
+    before they reach the queue, so it must not depend on the machine's
+    state; filters that do belong in filter_fn.
+
+    message_key_fn(message) maps a message to the key that states list
+    in HANDLES, so that states aren't called for messages they don't
+    handle (e.g. lambda msg: msg['type']).
+
+    With handler_timing=True (or a mortise.timing.HandlerTiming, which
+    may be shared between machines) the duration of every state handler
+    call is recorded per state class; see the handler_timing property.
+
+    With metrics=True (or a mortise.metrics.MachineMetrics, e.g. from
+    a MetricsRegistry) the machine counts messages, filtered (by
+    filter_fn or submit_filter_fn) and trapped messages, timeouts, retry
+    exhaustions and stalls; see the metrics property.
+
+    Given a tracer (mortise.trace.Tracer), sampled ticks, handler calls
+    and transitions are recorded on the machine's own track of its
+    timeline; see the tracer property.
+
+    With tick_status=True, tick() returns a TickStatus (and tick_many()
+    and drain() set the status of their TickSummary) rather than
+    raising StateMachineComplete or BlockedInUntimedState, so that
+    exceptions are left for actual errors.
+
+    Logging goes through an event_sink (see mortise.events). Nothing is
+    formatted unless a sink is attached and its level admits the
+    event. Without an event_sink, log_fn (print by default) is wrapped
+    in a LogFnSink; pass log_fn=None for a silent machine.
+
     """
     def __init__(self, initial_state, final_state,
                  default_error_state,
@@ -336,7 +741,23 @@ class StateMachine:
                  log_fn=print,
                  transition_fn=None,
                  common_state=None,
-                 dwell_states=None):
+                 dwell_states=None,
+                 timer_backend=None,
+                 history=HISTORY_AGGREGATE,
+                 history_size=1024,
+                 event_sink=None,
+                 reuse_states=False,
+                 serializer=pickle,
+                 journal=None,
+                 handler_timing=None,
+                 clock=None,
+                 message_key_fn=None,
+                 submit_filter_fn=None,
+                 queue_capacity=None,
+                 overflow=BLOCK,
+                 metrics=None,
+                 tracer=None,
+                 tick_status=False):
 
         # We want to make sure that initial/final/default_err states
         # are descriptors, not instances
@@ -350,9 +771,20 @@ class StateMachine:
         self._initial_st = initial_state
         self._final_st = final_state
         self._err_st = default_error_state
-        self._msg_queue = msg_queue or Queue()
-        self._timeout_queue = Queue()
-        self._log_fn = log_fn
+        if msg_queue is None and queue_capacity:
+            msg_queue = DequeQueue(queue_capacity, overflow)
+        msg_queue = msg_queue or self._default_queue()
+        self._msg_queue = msg_queue
+        # Timeouts waiting to be noticed by the tick loop (unless they
+        # are delivered through a priority lane, see _on_failsafe_timeout)
+        self._timeout_queue = collections.deque()
+        self._clock = clock or monotonic_clock
+        if timer_backend is None and isinstance(clock, TimerBackend):
+            timer_backend = clock
+        self._timers = timer_backend or default_timer_backend()
+        if event_sink is None and log_fn is not None:
+            event_sink = LogFnSink(log_fn)
+        self._sink = event_sink
         self._transition_fn = transition_fn
         self._on_err_fn = on_error_fn
 
@@ -362,9 +794,11 @@ class StateMachine:
         self._current = None
         self._finished = False
 
+        self._history_mode = history
+        self._history_size = history_size
         self.reset_transitions()
 
-        self._last_trans_time = datetime.now()
+        self._last_trans_ns = self._clock()
 
         # The filter and trap functions are used to filter messages
         # (for example, common messages that apply to the process
@@ -372,40 +806,200 @@ class StateMachine:
         # (so that one could, for example, raise an exception)
         self._filter_fn = filter_fn
         self._trap_fn = trap_fn
+        self._key_fn = message_key_fn
+        # Queues that coalesce messages per state (CoalescingQueue)
+        self._coalesce_fn = getattr(msg_queue, 'coalesce', None)
+        self._submit_filter_fn = submit_filter_fn
 
         self._shared_state = SharedState(self, common_state)
         self._dwell_states = dwell_states or []
 
+        # Per state class (is_final, is_dwell, allowed transitions),
+        # compiled from the declared TRANSITIONS
+        self._state_flags = transition_table(initial_state, final_state,
+                                             default_error_state,
+                                             self._dwell_states)
+        # Flags of states entered without being in the table
+        self._runtime_flags = {}
+        self._reuse_states = reuse_states
+        self._instances = {}
+        self._serializer = serializer
+        self._journal = journal
+        if handler_timing is True:
+            handler_timing = HandlerTiming()
+        self._timing = handler_timing or None
+        if metrics is True:
+            metrics = MachineMetrics()
+        self._metrics = metrics or None
+        if self._metrics is not None:
+            self._metrics.bind(self)
+        self._tracer = tracer.track(self) if tracer is not None else None
+        # Set while run() waits on file descriptors
+        self._waker = None
+        self._tick_status = tick_status
+        self._current_final = False
+        self._current_dwell = False
+        self._current_allowed = None
+        self._current_handles = None
+        # Bumped on every change of the current state, so that timeouts
+        # delivered as messages can be matched with their state
+        self._epoch = 0
+
         self.reset()
 
-    def start_failsafe_timer(self, duration):
-        def _wrap_timeout(state, timeout):
-            exception = StateTimedOut(
-                "State {} timed out after {} seconds"
-                .format(state, timeout)
-            )
-            self._timeout_queue.put(exception)
+    def _default_queue(self):
+        return Queue()
+
+    def _on_failsafe_timeout(self, state, timeout, epoch=None):
+        exception = StateTimedOut(
+            "State {} timed out after {} seconds"
+            .format(state, timeout)
+        )
+        exception.epoch = self._epoch if epoch is None else epoch
+
+        put_priority = getattr(self._msg_queue, 'put_priority', None)
+        if put_priority is not None:
+            # Jumps the queue, and wakes the consumer by itself
+            put_priority(exception)
+        else:
+            self._timeout_queue.append(exception)
             # No-op to make sure tick state machine
-            self._msg_queue.put(None)
+            self._wake()
+
+        waker = self._waker
+        if waker is not None:
+            waker.wake()
 
-        return Timer(duration, lambda x, y: _wrap_timeout(x, y),
-                     args=[self._current.name, duration])
+    def _wake(self):
+        # Runs on the timer thread, so it must not block. If the queue
+        # is full the consumer has plenty to wake it anyway
+        try:
+            self._msg_queue.put_nowait(None)
+        except Full:
+            pass
+
+    def _requeue(self, error):
+        put_priority = getattr(self._msg_queue, 'put_priority', None)
+        if put_priority is not None:
+            put_priority(error)
+            return
+        try:
+            self._msg_queue.put_nowait(error)
+        except Full:
+            # Raised again by the next tick, like a pending timeout
+            self._timeout_queue.append(error)
+
+    def _enqueue(self, message):
+        self._msg_queue.put(message)
+        waker = self._waker
+        if waker is not None:
+            waker.wake()
+
+    def submit(self, message):
+        """Puts a message on msg_queue, unless submit_filter_fn filters
+        it out. Runs on the caller's thread and may be called from any
+        thread. If submit_filter_fn raises, the exception is queued in
+        place of the message and raised (to on_error_fn, with the
+        message as shared_state.msg) when the machine gets to it.
+
+        Returns False if the message was filtered.
+
+        """
+        filter_fn = self._submit_filter_fn
+        if (filter_fn is not None and message and
+                not isinstance(message, Exception)):
+            try:
+                if filter_fn(message):
+                    if self._metrics is not None:
+                        self._metrics.count_submit_filtered()
+                    return False
+            except Exception as e:
+                message = SubmitFilterError(message, e)
+        self._enqueue(message)
+        return True
+
+    def start_failsafe_timer(self, duration):
+        return self._timers.timer(duration, self._on_failsafe_timeout,
+                                  (self._current.name, duration, self._epoch))
+
+    @property
+    def msg_queue(self):
+        return self._msg_queue
+
+    @property
+    def timer_backend(self):
+        return self._timers
+
+    @property
+    def clock(self):
+        return self._clock
 
     def reset_transitions(self):
         # We store transitions and times separately since we don't
         # want slightly different times to affect the set of actual transitions
         self._transition_id = 0
         self._transitions = set()
-        self._transition_times = collections.defaultdict(list)
+        self._history = TransitionHistory(self._history_mode,
+                                          self._history_size)
+
+    @property
+    def history(self):
+        return self._history
+
+    @property
+    def tracer(self):
+        """The machine's mortise.trace.TraceTrack, or None.
+
+        """
+        return self._tracer
+
+    @property
+    def metrics(self):
+        """The machine's mortise.metrics.MachineMetrics, or None.
+
+        """
+        return self._metrics
+
+    @property
+    def event_sink(self):
+        return self._sink
+
+    @property
+    def journal(self):
+        return self._journal
+
+    @property
+    def handler_timing(self):
+        """The HandlerTiming collecting state handler durations, or None
+        if handler timing is disabled. May be set to enable or disable
+        timing on a running machine.
+
+        """
+        return self._timing
+
+    @handler_timing.setter
+    def handler_timing(self, timing):
+        if timing is True:
+            timing = HandlerTiming()
+        self._timing = timing or None
+        if self._current is not None:
+            self._current._timing = self._timing
+
+    def _emit(self, level, kind, *args):
+        sink = self._sink
+        if sink is not None and sink.level <= level:
+            sink.emit(LogEvent(level, kind, self, args))
 
     def _transition(self, trans_state):
+        tracer = self._tracer
+        if tracer is not None and tracer.active:
+            trace_start = perf_counter_ns()
+
         # If the next state is a Push, save the push states on the
         # state stack and transition to the next state, if a pop, then
         # try to pull the top state off of the stack. Otherwise, just
         # transition to the state provided
-        if state_name(trans_state) == 'Push':
-            if not isinstance(trans_state, Push):
-                raise InvalidPushError("Push states mush be returned as an instance!")
+        if isinstance(trans_state, Push):
             if len(trans_state.push_states) < 2:
                 raise NoPushedStatesError("No states provided to push onto the stack")
 
@@ -414,7 +1008,9 @@ class StateMachine:
             for state in reversed(trans_state.push_states[1:]):
                 self._state_stack.append(state)
             next_state = trans_state.push_states[0]
-        elif state_name(trans_state) == 'Pop':
+        elif trans_state is Push:
+            raise InvalidPushError("Push states mush be returned as an instance!")
+        elif trans_state is Pop:
             if len(self._state_stack) == 0:
                 raise EmptyStateStackError("No states on stack!")
             next_state = self._state_stack.pop()
@@ -422,9 +1018,9 @@ class StateMachine:
             next_state = trans_state
 
         # Calculate time deltas for each transition
-        trans_time = datetime.now()
-        trans_delta = (trans_time - self._last_trans_time).total_seconds()
-        self._last_trans_time = trans_time
+        trans_ns = self._clock()
+        trans_delta = (trans_ns - self._last_trans_ns) / 1e9
+        self._last_trans_ns = trans_ns
 
         if self._current:
             cur_name = state_name(self._current)
@@ -438,15 +1034,15 @@ class StateMachine:
         trans_tup = (cur_base, cur_name, next_base, next_name)
 
         self._transitions.add(trans_tup)
-        self._transition_times[trans_tup].append((self._transition_id,
-                                                  trans_delta))
+        self._history.record(trans_tup, self._transition_id, trans_delta)
         self._transition_id += 1
 
-        if self._log_fn:
-            self._log_fn(
-                "State Transition: {} -> {}"
-                .format(cur_name, next_name)
-            )
+        if self._journal is not None:
+            self._journal.record_transition(cur_name, next_name)
+
+        sink = self._sink
+        if sink is not None and sink.level <= INFO:
+            sink.emit(LogEvent(INFO, TRANSITION, self, (cur_name, next_name)))
         if self._transition_fn:
             self._transition_fn(next_state, self._shared_state)
         # If we are preempting another state and haven't cleaned
@@ -454,42 +1050,95 @@ class StateMachine:
         if self._current and self._current.has_entered:
             self._current._reset()
 
-        self._current = next_state()
+        self._set_current(next_state)
+
+        if tracer is not None and tracer.active:
+            tracer.transition(cur_name, next_name, trace_start)
+
+    def _set_current(self, state):
+        self._current = self._instance(state)
+        self._epoch += 1
+        self._current._timing = self._timing
+        if self._key_fn is not None:
+            self._current_handles = self._current._mortise_meta.handles
+        if self._coalesce_fn is not None:
+            self._coalesce_fn(self._current._mortise_meta.coalesce)
+
+        flags = self._state_flags.get(state)
+        if flags is None:
+            flags = self._runtime_flags.get(state)
+            if flags is None:
+                flags = self._runtime_flags[state] = _state_record(
+                    state, self._final_st, self._err_st, self._dwell_states)
+        (self._current_final, self._current_dwell,
+         self._current_allowed) = flags
+
+    def _instance(self, state):
+        if self._reuse_states:
+            instance = self._instances.get(state)
+            if instance is not None:
+                instance._reset()
+                return instance
+
+            meta = getattr(state, '_mortise_meta', None)
+            if meta is not None and meta.reusable:
+                instance = self._instances[state] = state()
+                return instance
+
+        return state()
+
+    @property
+    def transition_graph(self):
+        """A mortise.graph.TransitionGraph of the transitions this
+        machine's states declare.
+
+        """
+        # mortise.graph builds on this module
+        from mortise.graph import TransitionGraph
+        return TransitionGraph(self._initial_st, self._final_st,
+                               self._err_st, self._dwell_states)
+
+    def graph_export(self, label_fn=None):
+        """A mortise.export.GraphExport of the transitions this machine
+        has taken and declared. By default edges are labelled as by
+        history.label().
+
+        """
+        # mortise.export builds on this module
+        from mortise.export import GraphExport
+        if label_fn is None:
+            label_fn = lambda edge, stats: self._history.label(edge)
+        return GraphExport(label_fn).add(self)
 
     @property
     def graphviz_digraph(self):
-        result = "digraph Cutter_State {\n\trankdir=LR;\n\tnodesep=0.5;\n"
-        clusters = collections.defaultdict(set)
-        transitions = ""
-        cluster_transitions = set()
-        for trans_tup in self._transitions:
-            (first_base, first, second_base, second) = trans_tup
-            clusters[first_base].add(first)
-            clusters[second_base].add(second)
-            cluster_transitions.add("{}->{}".format(first_base, second_base))
-            trans_deltas = self._transition_times[trans_tup]
-            trans_deltas_strs = ["{}: {:.2}".format(t_id, time)
-                                 for t_id, time in trans_deltas]
-            transitions += ("{}->{} [ label=\"{}\" ];\n"
-                            .format(first, second,
-                                    "\n".join(trans_deltas_strs)))
-
-        for cname, cluster in clusters.items():
-            result += "\tsubgraph cluster_{} {{\n".format(cname)
-            result += "\t\tlabel=\"{}\"".format(cname)
-            for node in cluster:
-                result += "\t\t{};\n".format(node)
-            result += "\tcolor=black;\n"
-            result += "\t}\n\n"
-
-        result += transitions
-        result += "}\n"
-        return result
+        buf = io.StringIO()
+        self.graph_export().write_dot(buf)
+        return buf.getvalue()
 
     def reset(self):
         self._is_finished = False
         self._transition(self._initial_st)
 
+    def snapshot(self):
+        """Returns a compact binary snapshot of the machine's current
+        state, state stack, retry counter, remaining timeout and common
+        state (see mortise.snapshot). Messages still in msg_queue are
+        not included.
+
+        """
+        return snapshot.dump(self)
+
+    def restore(self, data):
+        """Resumes this machine from a snapshot() taken from a machine
+        with the same configuration. The restored state continues where
+        it left off (on_enter is not re-run if it had already been
+        entered) and its failsafe timer is re-armed with the time that
+        was remaining.
+
+        """
+        snapshot.load(self, data)
+
     def clear_state_stack(self):
         self._state_stack = []
 
@@ -502,102 +1151,424 @@ class StateMachine:
         return self._is_finished
 
     def start_non_blocking(self):
+        """Runs a machine whose states move along by themselves (or
+        through timeouts) until it finishes, raising NonBlockingStalled
+        if it ever ends a tick with nothing queued. On finishing, raises
+        StateMachineComplete, or in tick_status mode returns.
+
+        """
         self._msg_queue.put(None)
         # Still need while loop for getting errors pushed into queue
         while True:
-            try:
-                # Still check messages for RetryLimitException
-                msg = self._msg_queue.get()
-                self.tick(msg)
-            except StateMachineComplete:
-                raise
-            if self._msg_queue.empty():
-                raise NonBlockingStalled(
-                    "Non-blocking state machine stalled in {}"
-                    .format(state_name(self._current)))
-
-    def tick(self, message=None):
-        self._shared_state.msg = message
+            # Still check messages for RetryLimitException
+            msg = self._msg_queue.get()
+            if self._non_blocking_done(self._status_tick(msg)):
+                return
 
-        # If this is a filtered message, no reason to call the state
-        # machine
+    def _non_blocking_done(self, status):
+        """Checks the TickStatus of a start_non_blocking() tick, and
+        returns True once it should return.
 
-        is_error_state = isinstance(message, Exception)
-        ok_to_filter = bool(message and self._filter_fn and not is_error_state)
+        """
+        if status is TickStatus.FINISHED:
+            if self._tick_status:
+                return True
+            raise StateMachineComplete()
+        if status is TickStatus.BLOCKED_UNTIMED:
+            raise self._blocked()
+        if self._msg_queue.empty():
+            raise NonBlockingStalled(
+                "Non-blocking state machine stalled in {}"
+                .format(state_name(self._current)))
+        return False
+
+    def run(self, sources=None):
+        """Ticks the state machine on the calling thread until it
+        completes, waiting for messages from msg_queue and, optionally,
+        file descriptors. Exceptions other than StateMachineComplete
+        propagate to the caller.
+
+        sources maps file objects (sockets, pipes, serial ports, anything
+        selectors accepts) to read_fn(fileobj) callables, which are
+        called when their file is readable and return the message to
+        tick with (or None for none yet). A read_fn that raises EOFError
+        has its source removed. While run() waits on sources, other
+        threads must hand it messages through submit(), which wakes it;
+        and since the sources can still deliver, a machine waiting on
+        them isn't considered stalled (no BlockedInUntimedState).
+
+        With an InlineTimerBackend as timer_backend, state timeouts are
+        fired by run() itself: every wait is bounded by the earliest
+        deadline, so the machine needs no other thread at all.
+
+        """
+        timers = self._timers
+        inline = isinstance(timers, InlineTimerBackend)
+        get_nowait = self._msg_queue.get_nowait
+
+        selector = None
+        if sources:
+            selector = selectors.DefaultSelector()
+            self._waker = _Waker()
+            selector.register(self._waker, selectors.EVENT_READ, None)
+            for fileobj, read_fn in sources.items():
+                selector.register(fileobj, selectors.EVENT_READ, read_fn)
 
-        filter_exception = None
         try:
-            if ok_to_filter and self._filter_fn(self._shared_state):
+            if self._run_tick(None, selector):
                 return
-        except Exception as e:
-            # Catching any exceptions raised from filtered messages
-            #  to raise them later in the try to pass to the on_error function
-            filter_exception = e
+            while True:
+                if inline:
+                    timers.fire_due()
+
+                try:
+                    message = get_nowait()
+                except Empty:
+                    pass
+                else:
+                    if self._run_tick(message, selector):
+                        return
+                    continue
+
+                timeout = timers.next_timeout() if inline else None
+                if selector is None:
+                    try:
+                        message = self._msg_queue.get(timeout=timeout)
+                    except Empty:
+                        continue
+                    if self._run_tick(message, selector):
+                        return
+                    continue
+
+                for key, _ in selector.select(timeout):
+                    if key.data is None:
+                        self._waker.drain()
+                        continue
+                    try:
+                        message = key.data(key.fileobj)
+                    except EOFError:
+                        selector.unregister(key.fileobj)
+                        continue
+                    if message is not None and self._run_tick(message,
+                                                              selector):
+                        return
+        finally:
+            if selector is not None:
+                selector.close()
+                self._waker.close()
+                self._waker = None
+            self.cleanup()
+
+    def _run_tick(self, message, selector):
+        """Ticks for run() and returns True once the machine has
+        finished.
+
+        """
+        status = self._status_tick(message)
+        if status is TickStatus.BLOCKED_UNTIMED and selector is None:
+            raise self._blocked()
+        return status is TickStatus.FINISHED
+
+    def tick(self, message=None):
+        if self._tick_status:
+            status = self._status_tick(message)
+            if status is TickStatus.BLOCKED_UNTIMED:
+                self._blocked()
+            return status
+        if self._tick_one(message):
+            self._finish_tick()
+
+    def _status_tick(self, message):
+        start_id = self._transition_id
+        if not self._tick_one(message):
+            return TickStatus.FILTERED
+        return self._tick_result(start_id)
+
+    def _tick_result(self, start_id):
+        """The TickStatus of a machine that has just been ticked, and
+        had taken start_id transitions before.
+
+        """
+        if self._is_finished:
+            return TickStatus.FINISHED
+        if self._stalled():
+            return TickStatus.BLOCKED_UNTIMED
+        if self._transition_id != start_id:
+            return TickStatus.TRANSITIONED
+        return TickStatus.WAITING
+
+    def tick_many(self, messages):
+        """Ticks the state machine once per message in an iterable,
+        with the same per-message semantics as tick() (filtering,
+        trapping, timeout precedence), but only checks for a stalled
+        machine once, after the last message. Stops early (and raises
+        StateMachineComplete) if the machine reaches its final state.
+
+        Returns a TickSummary of the messages processed, how many of
+        them were filtered and how many transitions were taken (and in
+        tick_status mode, the TickStatus it ended with instead of
+        raising).
+
+        """
+        start_id = self._transition_id
+        count = filtered = 0
+        for message in messages:
+            count += 1
+            if not self._tick_one(message):
+                filtered += 1
+            elif self._is_finished:
+                break
+        return self._tick_many_result(start_id, count, filtered)
+
+    def _tick_many_result(self, start_id, count, filtered):
+        if self._tick_status:
+            if count > filtered:
+                status = self._tick_result(start_id)
+                if status is TickStatus.BLOCKED_UNTIMED:
+                    self._blocked()
+            else:
+                status = TickStatus.FILTERED if count else TickStatus.WAITING
+            return TickSummary(count, filtered,
+                               self._transition_id - start_id, status)
+
+        summary = TickSummary(count, filtered,
+                              self._transition_id - start_id)
+        if count > filtered:
+            self._finish_tick()
+        return summary
+
+    def drain(self, max_items=None):
+        """tick_many() over the messages currently waiting in msg_queue
+        (at most max_items of them), without blocking.
+
+        """
+        return self.tick_many(self._drain_queue(max_items))
+
+    def _drain_queue(self, max_items):
+        get = self._msg_queue.get_nowait
+        count = 0
+        while max_items is None or count < max_items:
+            try:
+                message = get()
+            except Empty:
+                return
+            count += 1
+            yield message
+
+    def _tick_one(self, message):
+        """Runs the state machine on a single message and returns
+        False if the message was filtered.
+
+        """
+        tracer = self._tracer
+        if tracer is not None and not tracer.active and tracer.sample():
+            start = tracer.begin_tick(self)
+            try:
+                return self._tick_one(message)
+            finally:
+                tracer.end_tick(self, start)
+
+        # If this is a filtered message, no reason to call the state
+        # machine
+        received = self._receive(message)
+        if received is None:
+            return True
+        screen, filter_exception = received
+        if screen:
+            try:
+                if self._filter_fn and self._filter_fn(self._shared_state):
+                    if self._metrics is not None:
+                        self._metrics.filtered += 1
+                    return False
+                if self._skips_state(message):
+                    if self._trap_fn:
+                        self._trap_fn(self._shared_state)
+                    return True
+            except Exception as e:
+                # Catching any exceptions raised from filtered messages
+                #  to raise them later in the try to pass to the on_error
+                #  function
+                filter_exception = e
 
         fsm_busy = True
         while fsm_busy:
             try:
-                if isinstance(self._current, self._final_st):
-                    self._is_finished = True
-
-                if not self._timeout_queue.empty():
-                    raise self._timeout_queue.get()
+                if self._take_timeout():
+                    break
 
                 if filter_exception:
                     raise filter_exception
 
                 next_state = self._current.tick(self._shared_state)
 
-                if next_state in BLOCKING_RETURNS:
-                    # If we didn't return anything at all, or we
-                    # returned that we swallowed the message, we'll
-                    # assume that the FSM is no longer busy and is
-                    # waiting on some external message to move the
-                    # state along
-
-                    fsm_busy = False
-
-                    # Additionally, if there is a message, and we
-                    # returned nothing, we'll assume that the state
-                    # didn't handle the message, and trap it.
-                    should_trap = (self._shared_state.msg and
-                                   next_state is None and self._trap_fn)
-
-                    if should_trap:
-                        self._trap_fn(self._shared_state)
-
-                elif next_state:
-                    # If we returned any state clear the message
-                    self._shared_state.msg = None
-                    if state_name(next_state) != self._current.name:
-                        # Make sure timeouts are contained to their own state
-                        if not self._timeout_queue.empty():
-                            self._log_fn("Timed out while executing state. "
-                                         "Moving on anyway.")
-                            # drop timeout on the floor
-                            e = self._timeout_queue.get()
-                            self._log_fn(str(e))
-                        # Set our current state to the next state
-                        self._transition(next_state)
-
-                fsm_busy = fsm_busy and self._msg_queue.empty()
+                if self._trapped(next_state) and self._trap_fn:
+                    self._trap_fn(self._shared_state)
+                fsm_busy = self._handle_next_state(next_state)
             except (StateRetryLimitError, StateTimedOut) as e:
-                self._msg_queue.put(e)
+                self._state_failed(e)
                 break
             except Exception as e:
-                # While it's true that 'Pokemon errors' are typically
-                # in poor taste, this allows the user to selectively
-                # handle error cases, and throw any error that isn't
-                # explicitely handled
-                next_state = None
                 filter_exception = None
+                next_state = None
                 if self._on_err_fn:
                     next_state = self._on_err_fn(self._shared_state, e)
-                if next_state:
-                    self._transition(next_state)
-                else:
-                    raise e
+                self._handle_error(e, next_state)
+
+        return True
+
+    def _receive(self, message):
+        """Bookkeeping for a message about to be ticked. Returns None
+        for a stale timeout, which is dropped, otherwise (screen, error):
+        whether filter_fn and HANDLES apply to the message, and the
+        exception submit_filter_fn raised for it, if any.
+
+        """
+        self._shared_state.msg = message
+        if self._metrics is not None:
+            self._metrics.messages += 1
+
+        if self._journal is not None:
+            error = self._journal.record_message(message)
+            if error is not None:
+                self._emit(WARNING, UNRECORDED_MESSAGE,
+                           type(message).__qualname__, error)
+
+        if not isinstance(message, Exception):
+            return bool(message), None
+        if self._metrics is not None and isinstance(message, StateTimedOut):
+            # Counted here, on the ticking thread, rather than by the
+            # timer that fired it
+            self._metrics.timeouts += 1
+        if self._stale_timeout(message):
+            return None
+        if message.__class__ is SubmitFilterError:
+            # submit_filter_fn raised on the producer's side
+            self._shared_state.msg = message.message
+            return False, message.error
+        return False, None
+
+    def _skips_state(self, message):
+        """Returns True (and counts it as trapped) if message isn't in
+        the current state's HANDLES, so the state needn't be ticked.
+
+        """
+        if self._current_handles is None or not self._unhandled(message):
+            return False
+        if self._metrics is not None:
+            self._metrics.trapped += 1
+        return True
+
+    def _take_timeout(self):
+        """Runs before each step of a tick: notes a machine that reached
+        its final state, and hands a pending timeout back to the state
+        as a message, returning True to end the tick.
+
+        """
+        if self._current_final:
+            self._is_finished = True
+
+        if self._timeout_queue:
+            if self._journal is not None:
+                self._journal.record_timeout()
+            # Handed back to the state as a message
+            self._requeue(self._timeout_queue.popleft())
+            return True
+        return False
+
+    def _trapped(self, next_state):
+        """Returns True (and counts it) if the state returned nothing
+        for a message, which is then passed to trap_fn.
+
+        """
+        # If there is a message, and we returned nothing, we'll
+        # assume that the state didn't handle the message, and trap it.
+        if next_state is None and self._shared_state.msg:
+            if self._metrics is not None:
+                self._metrics.trapped += 1
+            return True
+        return False
+
+    def _state_failed(self, e):
+        if (self._metrics is not None and
+                isinstance(e, StateRetryLimitError)):
+            self._metrics.retry_limits += 1
+        self._requeue(e)
+
+    def _unhandled(self, message):
+        """Returns True if message can skip the current state because
+        it isn't in the state's HANDLES.
+
+        """
+        return (self._current.has_entered and not self._timeout_queue
+                and self._key_fn(message) not in self._current_handles)
+
+    def _stale_timeout(self, error):
+        """Returns True (after logging it) if error is a timeout that
+        was queued as a message for a state the machine has since left.
+
+        """
+        if getattr(error, 'epoch', self._epoch) != self._epoch:
+            self._emit(WARNING, STALE_TIMEOUT, error)
+            return True
+        return False
+
+    def _handle_next_state(self, next_state):
+        """Acts on the value returned from the current state's tick and
+        returns whether the FSM is still busy.
+
+        """
+        if next_state in BLOCKING_RETURNS:
+            # If we didn't return anything at all, or we
+            # returned that we swallowed the message, we'll
+            # assume that the FSM is no longer busy and is
+            # waiting on some external message to move the
+            # state along
+            return False
+
+        elif next_state:
+            # If we returned any state clear the message
+            self._shared_state.msg = None
+            current = self._current
+            if (next_state is not current and
+                    next_state is not current.__class__):
+                allowed = self._current_allowed
+                if allowed is not None and next_state not in allowed:
+                    raise UndeclaredTransitionError(
+                        "State {} returned {}, which is not in its "
+                        "TRANSITIONS".format(current.name,
+                                             state_name(next_state)))
+                # Make sure timeouts are contained to their own state
+                if self._timeout_queue:
+                    # drop timeout on the floor
+                    e = self._timeout_queue.popleft()
+                    if self._metrics is not None:
+                        self._metrics.timeouts += 1
+                    self._emit(WARNING, STALE_TIMEOUT, e)
+                # Set our current state to the next state
+                self._transition(next_state)
+
+        if not self._msg_queue.empty():
+            # Let the next message in
+            if self._journal is not None:
+                self._journal.record_yield()
+            return False
+        return True
+
+    def _handle_error(self, e, next_state):
+        """Moves to the state on_error_fn returned for e, or re-raises
+        e if it returned nothing.
+
+        """
+        # While it's true that 'Pokemon errors' are typically
+        # in poor taste, this allows the user to selectively
+        # handle error cases, and throw any error that isn't
+        # explicitely handled
+        if next_state:
+            self._transition(next_state)
+        else:
+            raise e
 
+    def _finish_tick(self):
         if self.is_finished:
             raise StateMachineComplete()
 
@@ -605,7 +1576,19 @@ class StateMachine:
         # have a timeout or isn't in one of the dwell_states passed in when
         # creating the state machine at the end of a tick an exception is
         # raised to indicate that the state machine is stalled.
-        if (self._msg_queue.empty() and self._current.TIMEOUT is None
-                and not any([isinstance(self._current, d_state)
-                             for d_state in self._dwell_states])):
-            raise BlockedInUntimedState(self._current)
+        if self._stalled():
+            raise self._blocked()
+
+    def _stalled(self):
+        return (self._msg_queue.empty() and self._current.TIMEOUT is None
+                and not self._current_dwell)
+
+    def _blocked(self):
+        """Counts a tick that ended blocked in an untimed state, raised
+        or returned as TickStatus.BLOCKED_UNTIMED, and returns the
+        BlockedInUntimedState to raise.
+
+        """
+        if self._metrics is not None:
+            self._metrics.blocked += 1
+        return BlockedInUntimedState(self._current)
@@ -0,0 +1,325 @@
+""" Message queues for state machines.
+
+A StateMachine's msg_queue only needs the subset of the queue.Queue
+interface that the machine uses: put(item, block, timeout),
+put_nowait, get(block, timeout), get_nowait, empty and qsize. Besides
+queue.Queue (the default, safe for any number of producers and
+consumers), queue.SimpleQueue can be passed in as a cheaper
+alternative, as can the DequeQueue below.
+
+A queue that also has a put_priority(item) method has a priority lane:
+the machine then delivers state timeouts and retry failures through it,
+ahead of any queued messages, instead of waking the consumer with a
+None message.
+"""
+
+import collections
+import queue
+import threading
+import time
+
+
+# Overflow policies for bounded queues
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+RAISE = 'raise'
+
+OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, RAISE)
+
+
+class DequeQueue:
+    """Single consumer message queue built on collections.deque, with
+    a priority lane.
+
+    put() and get_nowait() never take a lock. Only a consumer that
+    actually has to wait in get() takes a Condition, and producers only
+    touch it while a consumer is waiting. Any number of threads may put,
+    but only one thread may get at a time.
+
+    With a maxsize, put() applies the overflow policy once maxsize
+    messages are queued:
+
+    * BLOCK - wait for room (or raise queue.Full if block is False or
+      the timeout expires), like queue.Queue.
+    * DROP_OLDEST - drop the oldest queued message to make room.
+    * DROP_NEWEST - drop the message being put.
+    * RAISE - raise queue.Full.
+
+    Bounded puts are serialized on a lock. The priority lane is never
+    bounded, so timeouts and retry failures are never dropped and never
+    block. Dropped messages are counted in `dropped` and passed to
+    on_drop(key, message) (key is always None here).
+
+    on_high(queue) is called when the number of queued messages reaches
+    high_watermark, and on_low(queue) when it next falls to
+    low_watermark (0 by default), so that producers can throttle. Each
+    is called on the thread that crossed the mark.
+
+    """
+    __slots__ = ('_items', '_priority', '_cond', '_waiting', 'maxsize',
+                 'overflow', '_put_lock', '_not_full', '_producers_waiting',
+                 'high_watermark', 'low_watermark', '_on_high', '_on_low',
+                 '_above', '_on_drop', 'dropped')
+
+    def __init__(self, maxsize=0, overflow=BLOCK, high_watermark=None,
+                 low_watermark=0, on_high=None, on_low=None, on_drop=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: {}".format(overflow))
+        if high_watermark is not None and low_watermark >= high_watermark:
+            raise ValueError("low_watermark must be below high_watermark")
+
+        self._items = collections.deque()
+        self._priority = collections.deque()
+        self._cond = threading.Condition(threading.Lock())
+        self._waiting = False
+
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self._put_lock = threading.Lock()
+        self._not_full = threading.Condition(self._put_lock)
+        self._producers_waiting = 0
+
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self._on_high = on_high
+        self._on_low = on_low
+        self._above = False
+
+        self._on_drop = on_drop
+        self.dropped = 0
+
+    def _notify(self):
+        with self._cond:
+            self._cond.notify()
+
+    def _drop(self, item):
+        self.dropped += 1
+        if self._on_drop is not None:
+            self._on_drop(None, item)
+
+    def _put_bounded(self, item, block, timeout):
+        """Appends item under the put lock, applying the overflow
+        policy. Returns False if item was dropped.
+
+        """
+        items = self._items
+        with self._put_lock:
+            if len(items) >= self.maxsize:
+                overflow = self.overflow
+                if overflow == DROP_OLDEST:
+                    try:
+                        self._drop(items.popleft())
+                    except IndexError:
+                        pass
+                elif overflow == DROP_NEWEST:
+                    self._drop(item)
+                    return False
+                elif overflow == RAISE or not block:
+                    raise queue.Full
+                else:
+                    self._wait_not_full(timeout)
+            items.append(item)
+        return True
+
+    def _wait_not_full(self, timeout):
+        # Called with the put lock held. The consumer checks
+        # _producers_waiting after taking an item, so re-checking the
+        # length after setting it can't miss the room being made
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._producers_waiting += 1
+        try:
+            while len(self._items) >= self.maxsize:
+                if deadline is None:
+                    self._not_full.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Full
+                    self._not_full.wait(remaining)
+        finally:
+            self._producers_waiting -= 1
+
+    def _check_high(self):
+        with self._put_lock:
+            if self._above or len(self._items) < self.high_watermark:
+                return
+            self._above = True
+        if self._on_high is not None:
+            self._on_high(self)
+
+    def _check_low(self):
+        with self._put_lock:
+            if not self._above or len(self._items) > self.low_watermark:
+                return
+            self._above = False
+        if self._on_low is not None:
+            self._on_low(self)
+
+    def put(self, item, block=True, timeout=None):
+        if self.maxsize:
+            if not self._put_bounded(item, block, timeout):
+                return
+        else:
+            self._items.append(item)
+        if self._waiting:
+            self._notify()
+        if (self.high_watermark is not None and not self._above and
+                len(self._items) >= self.high_watermark):
+            self._check_high()
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def put_priority(self, item):
+        """Queues item ahead of every item queued with put(). The
+        priority lane is never bounded.
+
+        """
+        self._priority.append(item)
+        if self._waiting:
+            self._notify()
+
+    def get_nowait(self):
+        if self._priority:
+            return self._priority.popleft()
+        try:
+            item = self._items.popleft()
+        except IndexError:
+            raise queue.Empty
+        if self._producers_waiting:
+            with self._put_lock:
+                self._not_full.notify()
+        if self._above and len(self._items) <= self.low_watermark:
+            self._check_low()
+        return item
+
+    def get(self, block=True, timeout=None):
+        if self._priority or self._items or not block:
+            return self.get_nowait()
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            # Producers check _waiting after appending, so re-checking
+            # the deques after setting it can't miss an item
+            self._waiting = True
+            try:
+                while not (self._priority or self._items):
+                    if deadline is None:
+                        self._cond.wait()
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise queue.Empty
+                        self._cond.wait(remaining)
+            finally:
+                self._waiting = False
+        return self.get_nowait()
+
+    def empty(self):
+        return not (self._priority or self._items)
+
+    def qsize(self):
+        return len(self._priority) + len(self._items)
+
+    def full(self):
+        return bool(self.maxsize) and len(self._items) >= self.maxsize
+
+
+class _Cell:
+    __slots__ = ('key', 'item')
+
+    def __init__(self, key, item):
+        self.key = key
+        self.item = item
+
+
+class CoalescingQueue(DequeQueue):
+    """DequeQueue that keeps only the latest unprocessed message per
+    key for the keys being coalesced. A coalesced message that is put
+    while an older one with the same key is still queued replaces it in
+    place, keeping the older one's position, in O(1) through a key
+    index.
+
+    key_fn(message) gives a message's key (None and exceptions are
+    never coalesced). Which keys are coalesced is the union of `keys`
+    and the COALESCE of the machine's current state: True for every
+    key, or a collection of keys.
+
+    Every replaced message is counted in `dropped` and passed to
+    on_drop(key, message), if given, as are messages dropped by the
+    overflow policy. on_drop runs on the producer's thread, with the
+    queue locked. The remaining arguments are as for DequeQueue; a
+    coalesced message only counts once towards maxsize.
+
+    """
+    __slots__ = ('_key_fn', '_keys', '_state_keys', '_index', '_lock')
+
+    def __init__(self, key_fn, keys=(), on_drop=None, **kwargs):
+        super().__init__(on_drop=on_drop, **kwargs)
+        self._key_fn = key_fn
+        self._keys = frozenset(keys)
+        self._state_keys = None
+        self._index = {}
+        self._lock = threading.Lock()
+
+    def coalesce(self, state_keys):
+        """Called by the state machine with the COALESCE of each state
+        it enters.
+
+        """
+        self._state_keys = state_keys
+
+    def _coalesced(self, key):
+        state_keys = self._state_keys
+        return (key in self._keys or state_keys is True or
+                (state_keys is not None and key in state_keys))
+
+    def _drop(self, item):
+        key = None
+        if item.__class__ is _Cell:
+            key = item.key
+            with self._lock:
+                if self._index.get(key) is item:
+                    del self._index[key]
+                item = item.item
+
+        self.dropped += 1
+        if self._on_drop is not None:
+            self._on_drop(key, item)
+
+    def put(self, item, block=True, timeout=None):
+        if item is None or isinstance(item, Exception):
+            return super().put(item, block, timeout)
+
+        key = self._key_fn(item)
+        if not self._coalesced(key):
+            return super().put(item, block, timeout)
+
+        with self._lock:
+            cell = self._index.get(key)
+            if cell is not None:
+                dropped = cell.item
+                cell.item = item
+                self.dropped += 1
+                if self._on_drop is not None:
+                    self._on_drop(key, dropped)
+                return
+            cell = self._index[key] = _Cell(key, item)
+
+        try:
+            super().put(cell, block, timeout)
+        except queue.Full:
+            with self._lock:
+                if self._index.get(key) is cell:
+                    del self._index[key]
+            raise
+
+    def get_nowait(self):
+        item = super().get_nowait()
+        if item.__class__ is _Cell:
+            with self._lock:
+                if self._index.get(item.key) is item:
+                    del self._index[item.key]
+                item = item.item
+        return item
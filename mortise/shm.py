@@ -0,0 +1,295 @@
+""" Shared memory ring buffer for feeding a state machine from other
+processes.
+
+SharedRing lives in a multiprocessing.shared_memory block and carries
+fixed size binary records from one or more producer processes to a
+single consumer, without pickling. It implements the msg_queue
+interface, so it can be handed straight to a StateMachine, whose states
+then receive each record as a zero-copy memoryview into the ring.
+
+Layout (little endian):
+
+    header    magic:4s version:u16 flags:u16 slots:u32 slot_size:u32
+    head      u64 at offset 64, records published so far
+    tail      u64 at offset 128, records released by the consumer
+    slots     (seq:u64 length:u32 pad:u32 payload:bytes[slot_size]) * slots,
+              from offset 192
+
+Each slot's seq says whose turn it is: slot i starts at seq i, a
+producer may fill it for position p once seq == p and publishes it by
+setting seq = p + 1, and the consumer hands it back for position
+p + slots. Torn or stale reads of seq only ever look like "not yet",
+so no atomics are needed beyond stores becoming visible in program
+order (as they do on x86). Producers serialize on a
+multiprocessing.Lock only in MPSC mode.
+
+Nobody sleeps on a futex: a waiting side spins for a while, then
+sleeps with exponential backoff up to max_sleep.
+"""
+
+import collections
+import multiprocessing
+import queue
+import struct
+import sys
+import time
+from multiprocessing import shared_memory
+
+
+RING_MAGIC = b'MRTR'
+RING_VERSION = 1
+
+FLAG_MPSC = 0x01
+
+_HEADER = struct.Struct('<4sHHII')
+_COUNTER = struct.Struct('<Q')
+_SLOT = struct.Struct('<QI4x')
+_LENGTH = struct.Struct('<I')
+# Offset of a slot's length field
+_LENGTH_OFFSET = 8
+
+_HEAD_OFFSET = 64
+_TAIL_OFFSET = 128
+_SLOTS_OFFSET = 192
+
+# Backoff once spinning gives up
+_MIN_SLEEP = 0.00005
+
+
+def _attach(name, lock, record_format, spin, max_sleep):
+    record = struct.Struct(record_format) if record_format else None
+    return SharedRing(name, create=False, lock=lock, record=record,
+                      spin=spin, max_sleep=max_sleep)
+
+
+class SharedRing:
+    """Fixed slot ring buffer in shared memory, usable as a
+    StateMachine msg_queue.
+
+    The consumer creates the ring (create=True); producers attach to it
+    by name (create=False), or get it passed to them as a
+    multiprocessing.Process argument, which attaches on the other side.
+    With mpsc=True any number of producers may put; otherwise there
+    must only be one. Only one process may get.
+
+    put(data) copies a bytes-like object of at most slot_size bytes
+    into the next slot. With a struct.Struct `record`, put_record(*values)
+    packs the values straight into the slot and unpack(message) decodes
+    one.
+
+    get() returns a memoryview of the record's bytes inside the ring.
+    It is only valid until the next get() (i.e. for the tick it was
+    passed to), after which the slot may be reused; copy it with
+    bytes() to keep it. Memoryviews must be released before close().
+
+    None and exceptions (the state machine's own wakeups, timeouts and
+    retry failures) can't cross processes and go through a local lane
+    that get() serves first. This is also the ring's priority lane.
+
+    """
+    def __init__(self, name=None, slots=1024, slot_size=256, create=True,
+                 mpsc=False, lock=None, record=None, spin=1000,
+                 max_sleep=0.001):
+        self._create = create
+        self.record = record
+        self._spin = spin
+        self._max_sleep = max_sleep
+
+        if create:
+            if slots < 1 or slot_size < 1:
+                raise ValueError("slots and slot_size must be positive")
+            if record is not None and record.size > slot_size:
+                raise ValueError("record doesn't fit in slot_size")
+            stride = (_SLOT.size + slot_size + 7) & ~7
+            self._shm = shared_memory.SharedMemory(
+                name=name, create=True, size=_SLOTS_OFFSET + slots * stride)
+            buf = self._shm.buf
+            _HEADER.pack_into(buf, 0, RING_MAGIC, RING_VERSION,
+                              FLAG_MPSC if mpsc else 0, slots, slot_size)
+            _COUNTER.pack_into(buf, _HEAD_OFFSET, 0)
+            _COUNTER.pack_into(buf, _TAIL_OFFSET, 0)
+            for idx in range(slots):
+                _SLOT.pack_into(buf, _SLOTS_OFFSET + idx * stride, idx, 0)
+            if mpsc and lock is None:
+                lock = multiprocessing.Lock()
+        else:
+            kwargs = {}
+            if sys.version_info >= (3, 13):
+                # Only the creator unlinks the block
+                kwargs['track'] = False
+            self._shm = shared_memory.SharedMemory(name=name, **kwargs)
+            magic, version, flags, slots, slot_size = \
+                _HEADER.unpack_from(self._shm.buf, 0)
+            if magic != RING_MAGIC or version != RING_VERSION:
+                raise ValueError("{} is not a mortise ring".format(name))
+            mpsc = bool(flags & FLAG_MPSC)
+            if mpsc and lock is None:
+                raise ValueError("Producers on an MPSC ring need its lock")
+
+        self._buf = self._shm.buf
+        self.slots = slots
+        self.slot_size = slot_size
+        self.mpsc = mpsc
+        self.lock = lock
+        self._stride = (_SLOT.size + slot_size + 7) & ~7
+
+        # Consumer side: next position to read, and the slot handed out
+        # by the last get(), released on the next one
+        self._next = _COUNTER.unpack_from(self._buf, _TAIL_OFFSET)[0]
+        self._held = None
+        self._local = collections.deque()
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def __reduce__(self):
+        return (_attach, (self.name, self.lock,
+                          self.record.format if self.record else None,
+                          self._spin, self._max_sleep))
+
+    def _seq(self, offset):
+        return _COUNTER.unpack_from(self._buf, offset)[0]
+
+    def _slot_offset(self, pos):
+        return _SLOTS_OFFSET + (pos % self.slots) * self._stride
+
+    def _wait(self, ready, block, timeout, error):
+        if ready():
+            return
+        if not block:
+            raise error
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        spins = self._spin
+        sleep = _MIN_SLEEP
+        while not ready():
+            if spins:
+                spins -= 1
+                continue
+            if deadline is not None and time.monotonic() >= deadline:
+                raise error
+            time.sleep(sleep)
+            sleep = min(sleep * 2, self._max_sleep)
+
+    # Producer side
+
+    def _write(self, fill, block, timeout):
+        if self.lock is not None:
+            if timeout is None:
+                acquired = self.lock.acquire(block)
+            else:
+                acquired = self.lock.acquire(block, timeout)
+            if not acquired:
+                raise queue.Full
+        try:
+            pos = _COUNTER.unpack_from(self._buf, _HEAD_OFFSET)[0]
+            offset = self._slot_offset(pos)
+            self._wait(lambda: self._seq(offset) == pos, block, timeout,
+                       queue.Full)
+
+            start = offset + _SLOT.size
+            length = fill(self._buf, start)
+            # Publish the slot only once its contents and length are in
+            # place: the seq store must be the last write
+            _LENGTH.pack_into(self._buf, offset + _LENGTH_OFFSET, length)
+            _COUNTER.pack_into(self._buf, offset, pos + 1)
+            _COUNTER.pack_into(self._buf, _HEAD_OFFSET, pos + 1)
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+
+    def put(self, item, block=True, timeout=None):
+        if item is None or isinstance(item, Exception):
+            self._local.append(item)
+            return
+
+        data = memoryview(item).cast('B')
+        length = len(data)
+        if length > self.slot_size:
+            raise ValueError("Message of {} bytes doesn't fit in a {} byte "
+                             "slot".format(length, self.slot_size))
+
+        def fill(buf, start):
+            buf[start:start + length] = data
+            return length
+        self._write(fill, block, timeout)
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def put_record(self, *values, block=True, timeout=None):
+        """Packs values with the ring's record struct directly into the
+        next slot.
+
+        """
+        record = self.record
+
+        def fill(buf, start):
+            record.pack_into(buf, start, *values)
+            return record.size
+        self._write(fill, block, timeout)
+
+    def put_priority(self, item):
+        """Queues item on the local lane, ahead of the ring. Only the
+        consumer's process sees it.
+
+        """
+        self._local.append(item)
+
+    def unpack(self, message):
+        return self.record.unpack(message)
+
+    # Consumer side
+
+    def _release(self):
+        if self._held is not None:
+            offset, pos = self._held
+            self._held = None
+            _COUNTER.pack_into(self._buf, offset, pos + self.slots)
+            _COUNTER.pack_into(self._buf, _TAIL_OFFSET, pos + 1)
+
+    def _ready(self):
+        return bool(self._local) or (
+            self._seq(self._slot_offset(self._next)) == self._next + 1)
+
+    def get_nowait(self):
+        self._release()
+        if self._local:
+            return self._local.popleft()
+
+        pos = self._next
+        offset = self._slot_offset(pos)
+        if self._seq(offset) != pos + 1:
+            raise queue.Empty
+        # Only read once seq says the slot is published
+        length = _LENGTH.unpack_from(self._buf, offset + _LENGTH_OFFSET)[0]
+
+        self._next = pos + 1
+        self._held = (offset, pos)
+        start = offset + _SLOT.size
+        return self._buf[start:start + length]
+
+    def get(self, block=True, timeout=None):
+        self._release()
+        self._wait(self._ready, block, timeout, queue.Empty)
+        return self.get_nowait()
+
+    def empty(self):
+        return not self._ready()
+
+    def qsize(self):
+        head = _COUNTER.unpack_from(self._buf, _HEAD_OFFSET)[0]
+        return len(self._local) + max(head - self._next, 0)
+
+    def close(self):
+        self._release()
+        self._buf = None
+        self._shm.close()
+
+    def unlink(self):
+        """Removes the shared memory block (creator only, once every
+        process has closed it).
+
+        """
+        self._shm.unlink()
@@ -0,0 +1,170 @@
+""" Compact binary snapshots of a running StateMachine.
+
+A snapshot holds the current state class, the pushdown stack, the
+current state's retry counter and has_entered flag, the time left on
+its failsafe timer and the common state (encoded with the machine's
+serializer). State classes are stored by reference
+("module:qualname") and must be importable wherever the snapshot is
+restored.
+
+Layout (little endian):
+
+    header    version:u8 flags:u8 tries:i32 remaining:f64 stack_len:u16
+    current   len:u16 ref:bytes
+    stack     (len:u16 ref:bytes) * stack_len, bottom of the stack first
+    common    len:u32 blob:bytes (len 0 if there is no common state)
+"""
+
+import importlib
+import struct
+
+
+SNAPSHOT_VERSION = 1
+
+FLAG_ENTERED = 0x01
+FLAG_TIMEOUT_PENDING = 0x02
+FLAG_FINISHED = 0x04
+
+_HEADER = struct.Struct('<BBidH')
+_REF_LEN = struct.Struct('<H')
+_BLOB_LEN = struct.Struct('<I')
+
+# class -> length prefixed reference, and reference -> class
+_refs = {}
+_classes = {}
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def state_ref(cls):
+    """Returns the encoded reference used to store a state class.
+
+    """
+    return _packed_ref(cls)[_REF_LEN.size:]
+
+
+def _packed_ref(cls):
+    packed = _refs.get(cls)
+    if packed is None:
+        ref = "{}:{}".format(cls.__module__, cls.__qualname__).encode()
+        if len(ref) > 0xffff:
+            raise SnapshotError("State reference too long: {}".format(ref))
+        packed = _refs[cls] = _REF_LEN.pack(len(ref)) + ref
+    return packed
+
+
+def resolve_state(ref):
+    """Returns the state class for an encoded reference.
+
+    """
+    cls = _classes.get(ref)
+    if cls is not None:
+        return cls
+
+    module_name, _, qualname = ref.decode().partition(':')
+    if '<locals>' in qualname:
+        raise SnapshotError(
+            "Can't restore locally defined state {}".format(qualname))
+    try:
+        cls = importlib.import_module(module_name)
+        for attr in qualname.split('.'):
+            cls = getattr(cls, attr)
+    except (ImportError, AttributeError) as e:
+        raise SnapshotError(
+            "Can't resolve state {}: {}".format(ref.decode(), e))
+
+    _classes[ref] = cls
+    return cls
+
+
+def dump(fsm):
+    current = fsm._current
+    stack = fsm._state_stack
+
+    flags = 0
+    if current.has_entered:
+        flags |= FLAG_ENTERED
+    timer = current._failsafe_timer
+    # A timer that has fired but is still held by the state hasn't been
+    # handled yet, wherever its timeout is queued
+    if fsm._timeout_queue or (timer is not None and not timer.armed):
+        flags |= FLAG_TIMEOUT_PENDING
+    if fsm._is_finished:
+        flags |= FLAG_FINISHED
+
+    tries = -1 if current._tries is None else current._tries
+
+    remaining = -1.0
+    if timer is not None:
+        left = fsm._timers.remaining(timer)
+        if left is not None:
+            remaining = left
+
+    parts = [_HEADER.pack(SNAPSHOT_VERSION, flags, tries, remaining,
+                          len(stack)),
+             _packed_ref(current.__class__)]
+    for state in stack:
+        parts.append(_packed_ref(state))
+
+    common = fsm._shared_state.common
+    blob = fsm._serializer.dumps(common) if common is not None else b''
+    parts.append(_BLOB_LEN.pack(len(blob)))
+    parts.append(blob)
+
+    return b''.join(parts)
+
+
+def _read_ref(view, offset):
+    (length,) = _REF_LEN.unpack_from(view, offset)
+    offset += _REF_LEN.size
+    return bytes(view[offset:offset + length]), offset + length
+
+
+def load(fsm, data):
+    view = memoryview(data)
+    try:
+        (version, flags, tries, remaining,
+         stack_len) = _HEADER.unpack_from(view, 0)
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError(
+                "Unsupported snapshot version {}".format(version))
+
+        offset = _HEADER.size
+        ref, offset = _read_ref(view, offset)
+        current_cls = resolve_state(ref)
+
+        stack = []
+        for _ in range(stack_len):
+            ref, offset = _read_ref(view, offset)
+            stack.append(resolve_state(ref))
+
+        (blob_len,) = _BLOB_LEN.unpack_from(view, offset)
+        offset += _BLOB_LEN.size
+        blob = view[offset:offset + blob_len]
+        if len(blob) != blob_len:
+            raise SnapshotError("Truncated snapshot")
+    except struct.error as e:
+        raise SnapshotError("Corrupt snapshot: {}".format(e))
+
+    # Tear down whatever the machine was doing before
+    fsm.cleanup()
+    fsm._timeout_queue = type(fsm._timeout_queue)()
+
+    fsm._set_current(current_cls)
+    current = fsm._current
+    current._tries = None if tries < 0 else tries
+    current.has_entered = bool(flags & FLAG_ENTERED)
+
+    fsm._state_stack = stack
+    fsm._is_finished = bool(flags & FLAG_FINISHED)
+    if blob_len:
+        fsm._shared_state.common = fsm._serializer.loads(blob)
+
+    if remaining >= 0 and current.has_entered:
+        current._failsafe_timer = fsm.start_failsafe_timer(remaining)
+        current._failsafe_timer.start()
+
+    if flags & FLAG_TIMEOUT_PENDING:
+        fsm._on_failsafe_timeout(current.name, current.TIMEOUT)
@@ -1,6 +1,8 @@
 import mortise
 import unittest
 
+from mortise.clock import VirtualClock
+
 
 class FakeCommon:
     def __init__(self, entries):
@@ -23,6 +25,16 @@ def makeTestingInternalState(dictState):
     return FakeFSM(dictState)
 
 
+def makeVirtualStateMachine(initial_state, final_state, default_error_state,
+                            **kwargs):
+    """Creates a StateMachine running on a VirtualClock (fsm.clock),
+       so that its timeouts can be driven with
+       MortiseTest.advanceClock instead of waiting for them"""
+    kwargs.setdefault('clock', VirtualClock())
+    return mortise.StateMachine(initial_state, final_state,
+                                default_error_state, **kwargs)
+
+
 class MortiseTest(unittest.TestCase):
 
     def _next_state(self, fsm, state):
@@ -57,6 +69,35 @@ class MortiseTest(unittest.TestCase):
         self.assertNextState(mortise_state, next_state, initial_state,
                              mortise.StateRetryLimitError())
 
+    def advanceClock(self, fsm, seconds):
+        """Moves the VirtualClock of fsm forward, ticking the machine
+           each time a timer fires so that timeouts armed along the
+           way (e.g. by the state a timeout led to) fire too.
+
+           Timers are only armed by ticking the machine, so it needs an
+           initial fsm.tick() to enter its first state before the clock
+           can time it out. Ending up in an untimed state or the final
+           state is not an error here; check it with assertStateAfter"""
+        clock = fsm.clock
+        target = clock() + int(round(seconds * 1e9))
+        while True:
+            deadline = clock.next_deadline_ns()
+            if deadline is None or deadline > target:
+                break
+            clock.advance_to(deadline)
+            try:
+                fsm.drain()
+            except (mortise.BlockedInUntimedState,
+                    mortise.StateMachineComplete):
+                pass
+        clock.advance_to(target)
+
+    def assertStateAfter(self, fsm, seconds, state):
+        """Advances the clock of a virtual state machine (already
+           started with fsm.tick()) and checks the state it ends up in"""
+        self.advanceClock(fsm, seconds)
+        self.assertIsInstance(fsm._current, state)
+
     def _single_transition(self, mortise_state, initial_state=None, msg=None):
         current_state = mortise_state()
         fake_fsm = FakeFSM(initial_state or {})
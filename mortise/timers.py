@@ -0,0 +1,361 @@
+""" Timer backends used by mortise to arm state failsafe timers.
+
+A StateMachine asks its backend for a TimerHandle every time a state
+with a TIMEOUT is entered. The handle is armed with start() and
+disarmed with cancel(), mirroring the threading.Timer interface that
+mortise originally used directly.
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+import traceback
+import weakref
+
+
+class TimerHandle:
+    """A single timer owned by a TimerBackend. Handles are created
+    unarmed; start() arms them and cancel() disarms them. Calling
+    cancel() on a handle that has fired or was never started is a
+    no-op.
+
+    """
+    __slots__ = ('_backend', 'duration', 'deadline', '_fn', '_args',
+                 '_entry')
+
+    def __init__(self, backend, duration, fn, args):
+        self._backend = backend
+        self.duration = duration
+        self.deadline = None
+        self._fn = fn
+        self._args = args
+        self._entry = None
+
+    def start(self):
+        self._backend._arm(self)
+
+    def cancel(self):
+        if self._entry is not None:
+            self._backend._cancel(self)
+
+    @property
+    def armed(self):
+        return self._entry is not None
+
+    def _fire(self):
+        self._fn(*self._args)
+
+
+class TimerBackend:
+    """Base class for timer backends. Subclasses must implement
+    _arm/_cancel and keep armed_count up to date.
+
+    """
+    def __init__(self):
+        self._armed = 0
+
+    def timer(self, duration, fn, args=()):
+        return TimerHandle(self, duration, fn, args)
+
+    def remaining(self, handle):
+        """Seconds left before an armed handle fires (None if the
+        handle isn't armed).
+
+        """
+        if handle._entry is None:
+            return None
+        return max(handle.deadline - self._now(), 0.0)
+
+    def _now(self):
+        return time.monotonic()
+
+    @property
+    def armed_count(self):
+        """Number of timers that have been started and have neither
+        fired nor been cancelled.
+
+        """
+        return self._armed
+
+    def _arm(self, handle):
+        raise NotImplementedError
+
+    def _cancel(self, handle):
+        raise NotImplementedError
+
+
+class ThreadTimerBackend(TimerBackend):
+    """Legacy backend that starts one threading.Timer per armed timer.
+
+    """
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+
+    def _arm(self, handle):
+        timer = threading.Timer(handle.duration, self._fire, args=[handle])
+        timer.daemon = True
+        with self._lock:
+            handle._entry = timer
+            handle.deadline = time.monotonic() + handle.duration
+            self._armed += 1
+        timer.start()
+
+    def _cancel(self, handle):
+        with self._lock:
+            timer = handle._entry
+            if timer is None:
+                return
+            handle._entry = None
+            self._armed -= 1
+        timer.cancel()
+
+    def _fire(self, handle):
+        with self._lock:
+            if handle._entry is None:
+                return
+            handle._entry = None
+            self._armed -= 1
+        handle._fire()
+
+
+class HeapTimerBackend(TimerBackend):
+    """Single threaded timer scheduler backed by a binary heap.
+
+    All timers share one daemon thread which sleeps until the earliest
+    deadline. Cancellation only marks the heap entry as dead (O(1));
+    dead entries are skipped when they reach the top of the heap, and
+    the heap is compacted once dead entries outnumber live ones.
+
+    The thread doesn't survive a fork: in the child, the scheduler is
+    restarted for any timers inherited from the parent, and otherwise
+    on the next start().
+
+    """
+    # Don't bother compacting tiny heaps
+    COMPACT_THRESHOLD = 64
+
+    def __init__(self, clock=time.monotonic):
+        super().__init__()
+        self._clock = clock
+        self._heap = []
+        self._seq = itertools.count()
+        self._dead = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        _heap_backends.add(self)
+
+    def _after_fork(self):
+        # The lock may have been held by a thread that no longer exists
+        self._cond = threading.Condition()
+        self._thread = None
+        if self._armed:
+            self._start()
+
+    def _start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='mortise-timers', daemon=True)
+        self._thread.start()
+
+    def _arm(self, handle):
+        with self._cond:
+            if handle._entry is not None:
+                self._kill(handle)
+            handle.deadline = self._clock() + handle.duration
+            entry = [handle.deadline, next(self._seq), handle]
+            handle._entry = entry
+            heapq.heappush(self._heap, entry)
+            self._armed += 1
+
+            if self._thread is None:
+                self._start()
+            elif self._heap[0] is entry:
+                # New earliest deadline, wake the scheduler so that it
+                # can shorten its sleep
+                self._cond.notify()
+
+    def _cancel(self, handle):
+        with self._cond:
+            if handle._entry is not None:
+                self._kill(handle)
+
+    def _kill(self, handle):
+        handle._entry[2] = None
+        handle._entry = None
+        self._armed -= 1
+        self._dead += 1
+        if (self._dead > self.COMPACT_THRESHOLD and
+                self._dead > self._armed):
+            self._heap = [e for e in self._heap if e[2] is not None]
+            heapq.heapify(self._heap)
+            self._dead = 0
+
+    def _now(self):
+        return self._clock()
+
+    def _pop_due(self, now):
+        due = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            _, _, handle = heapq.heappop(heap)
+            if handle is None:
+                self._dead -= 1
+                continue
+            handle._entry = None
+            self._armed -= 1
+            due.append(handle)
+        return due
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due = self._pop_due(self._clock())
+                if not due:
+                    if self._heap:
+                        timeout = max(self._heap[0][0] - self._clock(), 0)
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout)
+                    continue
+
+            # Fire outside of the lock so that callbacks may arm or
+            # cancel other timers
+            for handle in due:
+                try:
+                    handle._fire()
+                except Exception:
+                    traceback.print_exc()
+
+
+class LoopTimerBackend(TimerBackend):
+    """Backend that schedules timers on an asyncio event loop with
+    loop.call_later, so no threads are involved. It must only be used
+    from the loop's thread. If no loop is given, the loop running when
+    the first timer is armed is used.
+
+    """
+    def __init__(self, loop=None):
+        super().__init__()
+        self._loop = loop
+
+    def _arm(self, handle):
+        if handle._entry is not None:
+            self._cancel(handle)
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        handle.deadline = self._loop.time() + handle.duration
+        handle._entry = self._loop.call_later(handle.duration,
+                                              self._fire, handle)
+        self._armed += 1
+
+    def _cancel(self, handle):
+        handle._entry.cancel()
+        handle._entry = None
+        self._armed -= 1
+
+    def _now(self):
+        return self._loop.time()
+
+    def _fire(self, handle):
+        if handle._entry is None:
+            return
+        handle._entry = None
+        self._armed -= 1
+        handle._fire()
+
+
+class InlineTimerBackend(TimerBackend):
+    """Backend whose timers never fire on their own: the thread that
+    owns it fires them by calling fire_due(), typically between waits
+    for messages with a timeout of next_timeout(). This is what
+    StateMachine.run() does, so that a machine and its timeouts run on
+    a single thread. It must only be used from that thread.
+
+    """
+    def __init__(self, clock=time.monotonic):
+        super().__init__()
+        self._clock = clock
+        self._heap = []
+        self._seq = itertools.count()
+
+    def _now(self):
+        return self._clock()
+
+    def _arm(self, handle):
+        if handle._entry is not None:
+            self._cancel(handle)
+        handle.deadline = self._clock() + handle.duration
+        entry = [handle.deadline, next(self._seq), handle]
+        handle._entry = entry
+        heapq.heappush(self._heap, entry)
+        self._armed += 1
+
+    def _cancel(self, handle):
+        handle._entry[2] = None
+        handle._entry = None
+        self._armed -= 1
+
+    def next_timeout(self):
+        """Seconds until the earliest armed timer is due (0 if one
+        already is), or None if no timer is armed.
+
+        """
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        return max(heap[0][0] - self._clock(), 0.0)
+
+    def fire_due(self):
+        """Fires every timer that is due, earliest first, and returns
+        how many fired.
+
+        """
+        fired = 0
+        heap = self._heap
+        now = self._clock()
+        while heap and heap[0][0] <= now:
+            _, _, handle = heapq.heappop(heap)
+            if handle is None:
+                continue
+            handle._entry = None
+            self._armed -= 1
+            handle._fire()
+            fired += 1
+        return fired
+
+
+_default_backend = None
+_default_backend_lock = threading.Lock()
+
+# Every HeapTimerBackend, so that their threads can be restarted in a
+# forked child
+_heap_backends = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    global _default_backend_lock
+    _default_backend_lock = threading.Lock()
+    for backend in list(_heap_backends):
+        backend._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def default_timer_backend():
+    """Returns the process wide HeapTimerBackend shared by all
+    StateMachines that weren't given an explicit timer_backend.
+
+    """
+    global _default_backend
+    if _default_backend is None:
+        with _default_backend_lock:
+            if _default_backend is None:
+                _default_backend = HeapTimerBackend()
+    return _default_backend
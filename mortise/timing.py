@@ -0,0 +1,84 @@
+""" Opt-in timing of state handlers.
+
+When a StateMachine is given a handler_timing, every call into
+on_enter, on_state, on_leave, on_timeout and on_fail is timed with
+time.perf_counter_ns and handed to its record() method. Without one,
+the only cost is a single `is None` check per handler call.
+"""
+
+from mortise.history import EdgeStats
+
+
+ON_ENTER = 'on_enter'
+ON_STATE = 'on_state'
+ON_LEAVE = 'on_leave'
+ON_TIMEOUT = 'on_timeout'
+ON_FAIL = 'on_fail'
+
+HANDLERS = (ON_ENTER, ON_STATE, ON_LEAVE, ON_TIMEOUT, ON_FAIL)
+
+
+class HandlerTiming:
+    """Aggregates handler durations per (state class, handler) into
+    EdgeStats with a nanosecond LogHistogram, so memory only grows with
+    the number of distinct states. A single HandlerTiming may be shared
+    between several machines (on one thread) to get combined figures.
+
+    Durations are in nanoseconds; for async handlers they include any
+    time spent awaiting.
+
+    """
+    def __init__(self):
+        self._stats = {}
+
+    def record(self, state, handler, start_ns, duration_ns):
+        key = (state.__class__, handler)
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = EdgeStats(scale=1)
+        stats.add(duration_ns)
+
+    def stats(self, state, handler=ON_STATE):
+        """Returns the EdgeStats for a state class (or instance) and
+        handler, or None if it was never called.
+
+        """
+        if not isinstance(state, type):
+            state = state.__class__
+        return self._stats.get((state, handler))
+
+    def items(self):
+        """Returns (state class, handler, EdgeStats) for everything
+        recorded so far.
+
+        """
+        return [(cls, handler, stats)
+                for (cls, handler), stats in self._stats.items()]
+
+    def summary(self):
+        """Returns {state name: {handler: {count, mean, min, max, p50,
+        p99}}}, with all times in nanoseconds (percentiles are bucket
+        upper bounds).
+
+        """
+        result = {}
+        for (cls, handler), stats in self._stats.items():
+            result.setdefault(cls.__name__, {})[handler] = {
+                'count': stats.count,
+                'mean': stats.mean,
+                'min': stats.min,
+                'max': stats.max,
+                'p50': stats.histogram.percentile(50),
+                'p99': stats.histogram.percentile(99),
+            }
+        return result
+
+    def merge(self, other):
+        for key, stats in other._stats.items():
+            mine = self._stats.get(key)
+            if mine is None:
+                mine = self._stats[key] = EdgeStats(scale=1)
+            mine.merge(stats)
+
+    def reset(self):
+        self._stats = {}
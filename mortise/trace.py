@@ -0,0 +1,195 @@
+""" Timeline tracing of state machines in Chrome trace-event format.
+
+A Tracer records ticks, state handler calls and transitions as
+complete ("X") events into a fixed size ring of preallocated arrays,
+and dumps them as Chrome trace-event JSON, which chrome://tracing and
+Perfetto (ui.perfetto.dev) can load. Each machine gets its own track
+(shown as a process) with a row per thread that ticked it.
+
+Only sampled ticks are traced: with sample_every=N, one tick in N per
+machine records its handler calls and transitions, the rest cost a
+counter decrement. Handler spans come through the handler_timing hook
+(see mortise.timing), which the machine only points at the tracer for
+the duration of a sampled tick.
+"""
+
+import itertools
+import json
+import threading
+from array import array
+from time import perf_counter_ns
+
+from mortise.mortise import state_name
+
+
+TICK = 'tick'
+HANDLER = 'handler'
+TRANSITION = 'transition'
+
+
+class TraceTrack:
+    """A single machine's track on a Tracer, created by the machine it
+    is passed to. name is shown as the track's title and may be
+    changed.
+
+    A TraceTrack stands in for the machine's handler_timing while a
+    sampled tick runs, forwarding to the real one (if any).
+
+    """
+    __slots__ = ('tracer', 'id', 'name', 'sample_every', '_countdown',
+                 'active', '_saved')
+
+    def __init__(self, tracer, track_id, name, sample_every):
+        self.tracer = tracer
+        self.id = track_id
+        self.name = name
+        self.sample_every = sample_every
+        self._countdown = 1
+        self.active = False
+        self._saved = None
+
+    def sample(self):
+        self._countdown -= 1
+        if self._countdown:
+            return False
+        self._countdown = self.sample_every
+        return True
+
+    def begin_tick(self, fsm):
+        self.active = True
+        self._saved = fsm._timing
+        fsm._timing = self
+        if fsm._current is not None:
+            fsm._current._timing = self
+        return perf_counter_ns()
+
+    def end_tick(self, fsm, start_ns):
+        end_ns = perf_counter_ns()
+        self.active = False
+        # Unless handler_timing was changed during the tick
+        if fsm._timing is self:
+            fsm._timing = self._saved
+            if fsm._current is not None:
+                fsm._current._timing = self._saved
+        self._saved = None
+        self.tracer.add(self.id, TICK, TICK, start_ns, end_ns - start_ns)
+
+    def record(self, state, handler, start_ns, duration_ns):
+        self.tracer.add(self.id, HANDLER,
+                        (state.__class__, handler), start_ns, duration_ns)
+        if self._saved is not None:
+            self._saved.record(state, handler, start_ns, duration_ns)
+
+    def transition(self, cur_name, next_name, start_ns):
+        self.tracer.add(self.id, TRANSITION, (cur_name, next_name),
+                        start_ns, perf_counter_ns() - start_ns)
+
+
+class Tracer:
+    """Ring buffer of trace events, shared by any number of machines on
+    any number of threads (pass it to each as tracer=). Once capacity
+    events have been recorded, the oldest are overwritten.
+
+    sample_every is the default for each machine's track.
+
+    """
+    def __init__(self, capacity=65536, sample_every=1):
+        if capacity < 1 or sample_every < 1:
+            raise ValueError("capacity and sample_every must be positive")
+
+        self.capacity = capacity
+        self.sample_every = sample_every
+        self._lock = threading.Lock()
+        self._tracks = []
+        self._names = {}
+        self._labels = []
+        self.reset()
+
+    def reset(self):
+        capacity = self.capacity
+        self._seq = itertools.count()
+        self._seqs = array('q', bytes(8 * capacity))
+        self._starts = array('q', bytes(8 * capacity))
+        self._durations = array('q', bytes(8 * capacity))
+        self._events = array('l', bytes(array('l').itemsize * capacity))
+        self._track_ids = array('l', bytes(array('l').itemsize * capacity))
+        self._threads = array('Q', bytes(8 * capacity))
+
+    def track(self, fsm, name=None):
+        with self._lock:
+            track_id = len(self._tracks)
+            if name is None:
+                name = "{}#{}".format(state_name(fsm._initial_st), track_id)
+            track = TraceTrack(self, track_id, name, self.sample_every)
+            self._tracks.append(track)
+        return track
+
+    def _event_id(self, kind, key):
+        with self._lock:
+            event_id = self._names.get((kind, key))
+            if event_id is None:
+                if kind == HANDLER:
+                    label = "{}.{}".format(key[0].__name__, key[1])
+                elif kind == TRANSITION:
+                    label = "{} -> {}".format(*key)
+                else:
+                    label = key
+                event_id = self._names[(kind, key)] = len(self._labels)
+                self._labels.append((label, kind))
+        return event_id
+
+    def add(self, track_id, kind, key, start_ns, duration_ns):
+        event_id = self._names.get((kind, key))
+        if event_id is None:
+            event_id = self._event_id(kind, key)
+
+        # next() on a count is atomic, so concurrent writers never
+        # share a slot
+        seq = next(self._seq)
+        pos = seq % self.capacity
+        self._starts[pos] = start_ns
+        self._durations[pos] = duration_ns
+        self._events[pos] = event_id
+        self._track_ids[pos] = track_id
+        self._threads[pos] = threading.get_ident()
+        self._seqs[pos] = seq + 1
+
+    def events(self):
+        """Returns the Chrome trace events held in the ring, oldest
+        first, preceded by the metadata events naming tracks and
+        threads.
+
+        """
+        slots = sorted((seq, pos) for pos, seq in enumerate(self._seqs)
+                       if seq)
+        thread_names = dict((thread.ident, thread.name)
+                            for thread in threading.enumerate())
+
+        result = []
+        seen_threads = set()
+        for track in self._tracks:
+            result.append({'ph': 'M', 'name': 'process_name', 'pid': track.id,
+                           'args': {'name': track.name}})
+        for _, pos in slots:
+            label, kind = self._labels[self._events[pos]]
+            track_id = self._track_ids[pos]
+            tid = self._threads[pos]
+            if (track_id, tid) not in seen_threads:
+                seen_threads.add((track_id, tid))
+                result.append({
+                    'ph': 'M', 'name': 'thread_name', 'pid': track_id,
+                    'tid': tid, 'args': {'name': thread_names.get(
+                        tid, "Thread {}".format(tid))}})
+            result.append({'ph': 'X', 'name': label, 'cat': kind,
+                           'ts': self._starts[pos] / 1e3,
+                           'dur': self._durations[pos] / 1e3,
+                           'pid': track_id, 'tid': tid})
+        return result
+
+    def dump(self, fp):
+        """Writes the trace as Chrome trace-event JSON to a text file
+        object.
+
+        """
+        json.dump({'traceEvents': self.events(),
+                   'displayTimeUnit': 'ns'}, fp)
@@ -55,11 +55,13 @@ setup(
 
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
     ],
 
+    # State metadata is computed in State.__init_subclass__ and the
+    # journal relies on time.monotonic_ns
+    python_requires='>=3.7',
+
     # What does your project relate to?
     keywords='state fsm',
 
@@ -0,0 +1,329 @@
+import queue
+import threading
+import unittest
+
+import mortise
+from mortise import State
+from mortise.queues import (DequeQueue, CoalescingQueue, BLOCK, DROP_OLDEST,
+                            DROP_NEWEST, RAISE)
+
+
+class ErrorState(State):
+    def on_state(self, st):
+        pass
+
+
+class Waiting(State):
+    TIMEOUT = 60
+
+    def on_state(self, st):
+        return True
+
+
+class DequeQueueTest(unittest.TestCase):
+
+    def test_fifo(self):
+        q = DequeQueue()
+        for item in range(5):
+            q.put(item)
+        self.assertEqual(q.qsize(), 5)
+        self.assertEqual([q.get_nowait() for _ in range(5)], list(range(5)))
+        self.assertTrue(q.empty())
+        self.assertRaises(queue.Empty, q.get_nowait)
+        self.assertRaises(queue.Empty, q.get, timeout=0.01)
+
+    def test_priority_lane_goes_first(self):
+        q = DequeQueue()
+        q.put('a')
+        q.put('b')
+        q.put_priority('p1')
+        q.put_priority('p2')
+        self.assertEqual([q.get_nowait() for _ in range(4)],
+                         ['p1', 'p2', 'a', 'b'])
+
+    def test_priority_lane_is_not_bounded(self):
+        q = DequeQueue(maxsize=1, overflow=RAISE)
+        q.put('a')
+        q.put_priority('p1')
+        q.put_priority('p2')
+        self.assertEqual(q.qsize(), 3)
+        self.assertEqual(q.dropped, 0)
+        self.assertEqual([q.get_nowait() for _ in range(3)],
+                         ['p1', 'p2', 'a'])
+
+    def test_priority_lane_wakes_blocked_consumer(self):
+        q = DequeQueue()
+        result = []
+        consumer = threading.Thread(target=lambda: result.append(q.get()))
+        consumer.start()
+        q.put_priority('p')
+        consumer.join(5)
+        self.assertEqual(result, ['p'])
+
+    def test_block_without_blocking_raises(self):
+        q = DequeQueue(maxsize=2, overflow=BLOCK)
+        q.put('a')
+        q.put('b')
+        self.assertTrue(q.full())
+        self.assertRaises(queue.Full, q.put_nowait, 'c')
+        self.assertRaises(queue.Full, q.put, 'c', timeout=0.01)
+        self.assertEqual([q.get_nowait() for _ in range(2)], ['a', 'b'])
+        self.assertEqual(q.dropped, 0)
+
+    def test_block_waits_for_room(self):
+        q = DequeQueue(maxsize=1, overflow=BLOCK)
+        q.put('a')
+        producer = threading.Thread(target=q.put, args=['b'])
+        producer.start()
+        producer.join(0.05)
+        self.assertTrue(producer.is_alive())
+
+        self.assertEqual(q.get_nowait(), 'a')
+        producer.join(5)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(q.get_nowait(), 'b')
+
+    def test_drop_oldest(self):
+        drops = []
+        q = DequeQueue(maxsize=2, overflow=DROP_OLDEST,
+                       on_drop=lambda key, item: drops.append((key, item)))
+        for item in 'abcd':
+            q.put(item)
+        self.assertEqual([q.get_nowait() for _ in range(2)], ['c', 'd'])
+        self.assertEqual(q.dropped, 2)
+        self.assertEqual(drops, [(None, 'a'), (None, 'b')])
+
+    def test_drop_newest(self):
+        drops = []
+        q = DequeQueue(maxsize=2, overflow=DROP_NEWEST,
+                       on_drop=lambda key, item: drops.append((key, item)))
+        for item in 'abcd':
+            q.put(item)
+        self.assertEqual([q.get_nowait() for _ in range(2)], ['a', 'b'])
+        self.assertEqual(q.dropped, 2)
+        self.assertEqual(drops, [(None, 'c'), (None, 'd')])
+
+    def test_raise(self):
+        q = DequeQueue(maxsize=1, overflow=RAISE)
+        q.put('a')
+        # Even when asked to block
+        self.assertRaises(queue.Full, q.put, 'b', True, 5)
+        self.assertEqual(q.qsize(), 1)
+        self.assertEqual(q.dropped, 0)
+
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, DequeQueue, overflow='spill')
+        self.assertRaises(ValueError, DequeQueue, high_watermark=2,
+                          low_watermark=2)
+
+    def test_watermarks(self):
+        events = []
+        q = DequeQueue(high_watermark=3, low_watermark=1,
+                       on_high=lambda q: events.append('high'),
+                       on_low=lambda q: events.append('low'))
+        for item in range(5):
+            q.put(item)
+        self.assertEqual(events, ['high'])
+
+        q.get_nowait()
+        q.get_nowait()
+        q.get_nowait()
+        self.assertEqual(events, ['high'])
+        q.get_nowait()
+        self.assertEqual(events, ['high', 'low'])
+        q.get_nowait()
+        self.assertEqual(events, ['high', 'low'])
+
+        # Armed again
+        for item in range(3):
+            q.put(item)
+        self.assertEqual(events, ['high', 'low', 'high'])
+
+    def _producers(self, q, producers, count):
+        threads = [threading.Thread(
+            target=lambda idx: [q.put((idx, seq)) for seq in range(count)],
+            args=[idx]) for idx in range(producers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def _consume(self, q, total):
+        last = {}
+        for _ in range(total):
+            producer, seq = q.get(timeout=5)
+            # Each producer's messages arrive in order
+            self.assertEqual(seq, last.get(producer, -1) + 1)
+            last[producer] = seq
+        return last
+
+    def test_concurrent_producers(self):
+        q = DequeQueue()
+        threads = self._producers(q, 4, 5000)
+        last = self._consume(q, 4 * 5000)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(last, dict((idx, 4999) for idx in range(4)))
+        self.assertTrue(q.empty())
+
+    def test_concurrent_producers_bounded(self):
+        q = DequeQueue(maxsize=8, overflow=BLOCK)
+        threads = self._producers(q, 4, 2000)
+        seen = 0
+        for _ in range(4 * 2000):
+            self.assertLessEqual(len(q._items), q.maxsize)
+            q.get(timeout=5)
+            seen += 1
+        for thread in threads:
+            thread.join()
+        self.assertEqual(seen, 4 * 2000)
+        self.assertEqual(q.dropped, 0)
+
+    def test_concurrent_producers_drop_oldest(self):
+        q = DequeQueue(maxsize=8, overflow=DROP_OLDEST)
+        threads = self._producers(q, 4, 2000)
+        for thread in threads:
+            thread.join()
+        received = 0
+        while not q.empty():
+            q.get_nowait()
+            received += 1
+        self.assertEqual(received, 8)
+        self.assertEqual(received + q.dropped, 4 * 2000)
+
+    def test_machine_timeout_takes_priority_lane(self):
+        q = DequeQueue()
+        fsm = mortise.StateMachine(Waiting, mortise.DefaultStates.End,
+                                   ErrorState, msg_queue=q, log_fn=None)
+        fsm.tick()
+        q.put('a')
+        q.put('b')
+        fsm._on_failsafe_timeout('Waiting', 60)
+        self.assertIsInstance(q.get_nowait(), mortise.StateTimedOut)
+        self.assertEqual([q.get_nowait(), q.get_nowait()], ['a', 'b'])
+        fsm.cleanup()
+
+
+def _key(message):
+    return message[0]
+
+
+class CoalescingQueueTest(unittest.TestCase):
+
+    def test_replacement_keeps_position(self):
+        drops = []
+        q = CoalescingQueue(_key, keys=['a'], on_drop=lambda key, item:
+                            drops.append((key, item)))
+        q.put(('a', 1))
+        q.put(('b', 1))
+        q.put(('a', 2))
+        q.put(('b', 2))
+        q.put(('a', 3))
+        self.assertEqual(q.qsize(), 3)
+        self.assertEqual([q.get_nowait() for _ in range(3)],
+                         [('a', 3), ('b', 1), ('b', 2)])
+        self.assertEqual(q.dropped, 2)
+        self.assertEqual(drops, [('a', ('a', 1)), ('a', ('a', 2))])
+
+    def test_delivered_message_is_not_replaced(self):
+        q = CoalescingQueue(_key, keys=['a'])
+        q.put(('a', 1))
+        self.assertEqual(q.get_nowait(), ('a', 1))
+        q.put(('a', 2))
+        self.assertEqual(q.get_nowait(), ('a', 2))
+        self.assertEqual(q.dropped, 0)
+
+    def test_state_keys(self):
+        q = CoalescingQueue(_key)
+        q.put(('a', 1))
+        q.put(('a', 2))
+        self.assertEqual(q.qsize(), 2)
+
+        q.coalesce(frozenset(['a']))
+        q.put(('a', 3))
+        q.put(('a', 4))
+        q.put(('b', 1))
+        q.put(('b', 2))
+        self.assertEqual([q.get_nowait() for _ in range(5)],
+                         [('a', 1), ('a', 2), ('a', 4), ('b', 1), ('b', 2)])
+
+        q.coalesce(True)
+        q.put(('b', 3))
+        q.put(('b', 4))
+        self.assertEqual(q.qsize(), 1)
+        self.assertEqual(q.get_nowait(), ('b', 4))
+
+    def test_none_and_exceptions_are_not_coalesced(self):
+        q = CoalescingQueue(lambda message: 'same')
+        q.coalesce(True)
+        error = mortise.StateTimedOut()
+        q.put(None)
+        q.put(None)
+        q.put(error)
+        q.put(error)
+        self.assertEqual(q.qsize(), 4)
+        self.assertEqual(q.dropped, 0)
+
+    def test_priority_lane_goes_first(self):
+        q = CoalescingQueue(_key, keys=['a'])
+        q.put(('a', 1))
+        q.put(('a', 2))
+        q.put_priority('p')
+        self.assertEqual([q.get_nowait(), q.get_nowait()], ['p', ('a', 2)])
+
+    def test_coalesced_message_counts_once_towards_maxsize(self):
+        q = CoalescingQueue(_key, keys=['a'], maxsize=2, overflow=RAISE)
+        q.put(('a', 1))
+        q.put(('b', 1))
+        # Replaces in place, so there is no overflow
+        q.put(('a', 2))
+        self.assertRaises(queue.Full, q.put, ('c', 1))
+        self.assertEqual([q.get_nowait(), q.get_nowait()],
+                         [('a', 2), ('b', 1)])
+
+    def test_overflow_drops_unindex_cell(self):
+        drops = []
+        q = CoalescingQueue(_key, keys=['a'], maxsize=1,
+                            overflow=DROP_OLDEST, on_drop=lambda key, item:
+                            drops.append((key, item)))
+        q.put(('a', 1))
+        q.put(('b', 1))
+        self.assertEqual(drops, [('a', ('a', 1))])
+        # The dropped cell must not be replaced in place any more
+        q.put(('a', 2))
+        self.assertEqual(q.get_nowait(), ('a', 2))
+        self.assertTrue(q.empty())
+
+    def test_full_coalesced_put_can_be_retried(self):
+        q = CoalescingQueue(_key, keys=['a'], maxsize=1, overflow=RAISE)
+        q.put(('b', 1))
+        self.assertRaises(queue.Full, q.put, ('a', 1))
+        q.get_nowait()
+        q.put(('a', 2))
+        self.assertEqual(q.get_nowait(), ('a', 2))
+
+    def test_concurrent_coalescing(self):
+        q = CoalescingQueue(_key, keys=['a', 'b'])
+
+        def produce(key):
+            for seq in range(5000):
+                q.put((key, seq))
+
+        threads = [threading.Thread(target=produce, args=[key])
+                   for key in 'ab']
+        for thread in threads:
+            thread.start()
+        last = {}
+        received = 0
+        while any(thread.is_alive() for thread in threads) or not q.empty():
+            try:
+                key, seq = q.get(timeout=0.01)
+            except queue.Empty:
+                continue
+            received += 1
+            # Replacement never reorders a key's messages
+            self.assertGreater(seq, last.get(key, -1))
+            last[key] = seq
+        for thread in threads:
+            thread.join()
+        self.assertEqual(last, {'a': 4999, 'b': 4999})
+        self.assertEqual(received + q.dropped, 2 * 5000)
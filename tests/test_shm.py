@@ -0,0 +1,147 @@
+import multiprocessing
+import queue
+import struct
+import unittest
+
+import mortise
+from mortise import State
+from mortise.shm import SharedRing
+
+
+RECORD = struct.Struct('<II')
+
+
+def _produce(ring, producer, count):
+    for seq in range(count):
+        ring.put_record(producer, seq)
+    ring.close()
+
+
+class ErrorState(State):
+    def on_state(self, st):
+        pass
+
+
+class Waiting(State):
+    TIMEOUT = 60
+
+    def on_state(self, st):
+        return True
+
+
+class SharedRingTest(unittest.TestCase):
+
+    def _ring(self, **kwargs):
+        ring = SharedRing(**kwargs)
+        self.addCleanup(ring.unlink)
+        self.addCleanup(ring.close)
+        return ring
+
+    def test_put_get(self):
+        ring = self._ring(slots=4, slot_size=8)
+        ring.put(b'abc')
+        ring.put(bytearray(b'defgh'))
+        self.assertEqual(ring.qsize(), 2)
+        self.assertEqual(bytes(ring.get_nowait()), b'abc')
+        self.assertEqual(bytes(ring.get_nowait()), b'defgh')
+        self.assertTrue(ring.empty())
+        self.assertRaises(queue.Empty, ring.get_nowait)
+        self.assertRaises(queue.Empty, ring.get, timeout=0.01)
+
+    def test_records(self):
+        ring = self._ring(slots=4, slot_size=8, record=RECORD)
+        ring.put_record(1, 2)
+        self.assertEqual(ring.unpack(ring.get_nowait()), (1, 2))
+
+    def test_oversized_message(self):
+        ring = self._ring(slots=4, slot_size=4)
+        self.assertRaises(ValueError, ring.put, b'12345')
+        self.assertRaises(ValueError, SharedRing, slots=4, slot_size=4,
+                          record=RECORD)
+
+    def test_full(self):
+        ring = self._ring(slots=2, slot_size=4)
+        ring.put(b'a')
+        ring.put(b'b')
+        self.assertRaises(queue.Full, ring.put_nowait, b'c')
+        self.assertRaises(queue.Full, ring.put, b'c', timeout=0.01)
+
+        # A slot is only reused once the consumer has moved past it
+        self.assertEqual(bytes(ring.get_nowait()), b'a')
+        self.assertRaises(queue.Full, ring.put_nowait, b'c')
+        self.assertEqual(bytes(ring.get_nowait()), b'b')
+        ring.put_nowait(b'c')
+        self.assertEqual(bytes(ring.get_nowait()), b'c')
+
+    def test_wraps_around(self):
+        ring = self._ring(slots=3, slot_size=8, record=RECORD)
+        for seq in range(100):
+            ring.put_record(0, seq)
+            ring.put_record(1, seq)
+            self.assertEqual(ring.unpack(ring.get_nowait()), (0, seq))
+            self.assertEqual(ring.unpack(ring.get_nowait()), (1, seq))
+        self.assertTrue(ring.empty())
+
+    def test_local_lane_goes_first(self):
+        ring = self._ring(slots=4, slot_size=4)
+        error = mortise.StateTimedOut()
+        ring.put(b'a')
+        ring.put(None)
+        ring.put(error)
+        ring.put_priority(b'p')
+        self.assertEqual(ring.qsize(), 4)
+        self.assertIsNone(ring.get_nowait())
+        self.assertIs(ring.get_nowait(), error)
+        self.assertEqual(ring.get_nowait(), b'p')
+        self.assertEqual(bytes(ring.get_nowait()), b'a')
+
+    def test_machine_timeout_takes_local_lane(self):
+        ring = self._ring(slots=4, slot_size=4)
+        fsm = mortise.StateMachine(Waiting, mortise.DefaultStates.End,
+                                   ErrorState, msg_queue=ring, log_fn=None)
+        fsm.tick()
+        ring.put(b'a')
+        fsm._on_failsafe_timeout('Waiting', 60)
+        self.assertIsInstance(ring.get_nowait(), mortise.StateTimedOut)
+        self.assertEqual(bytes(ring.get_nowait()), b'a')
+        fsm.cleanup()
+
+    def test_mpsc_producers_need_the_lock(self):
+        ring = self._ring(slots=4, slot_size=8, mpsc=True)
+        self.assertRaises(ValueError, SharedRing, ring.name, create=False)
+        attached = SharedRing(ring.name, create=False, lock=ring.lock)
+        self.assertTrue(attached.mpsc)
+        attached.close()
+
+    def _consume(self, ring, producers, count):
+        last = {}
+        for _ in range(producers * count):
+            producer, seq = ring.unpack(ring.get(timeout=10))
+            # Each producer's records arrive in order, none torn
+            self.assertEqual(seq, last.get(producer, -1) + 1)
+            last[producer] = seq
+        self.assertTrue(ring.empty())
+        return last
+
+    def _run_producers(self, ring, producers, count):
+        processes = [multiprocessing.Process(target=_produce,
+                                             args=(ring, idx, count))
+                     for idx in range(producers)]
+        for process in processes:
+            process.start()
+        last = self._consume(ring, producers, count)
+        for process in processes:
+            process.join(10)
+            self.assertEqual(process.exitcode, 0)
+        return last
+
+    def test_spsc_across_processes(self):
+        # Small enough that the producer keeps finding the ring full
+        ring = self._ring(slots=16, slot_size=8, record=RECORD)
+        last = self._run_producers(ring, 1, 20000)
+        self.assertEqual(last, {0: 19999})
+
+    def test_mpsc_across_processes(self):
+        ring = self._ring(slots=16, slot_size=8, record=RECORD, mpsc=True)
+        last = self._run_producers(ring, 3, 10000)
+        self.assertEqual(last, {0: 9999, 1: 9999, 2: 9999})